@@ -0,0 +1,78 @@
+"""
+Micro-benchmark of the packet codecs: encodes and decodes a few
+common packets with :func:`pyclassic.utils.encode_packet` and
+:func:`pyclassic.utils.decode_packet`. For reference, the same packets
+are also encoded and decoded field by field like the codecs used to.
+
+Usage::
+
+    python benchmarks/bench_codec.py [iterations]
+"""
+import sys, timeit
+from pyclassic.utils import *
+
+samples = {
+    # The legacy encoder cannot encode negative SBYTE values.
+    "POS": (3, 1, 2, 3),
+    "SET_BLOCK": (10, 20, 30, 1),
+    "SPAWN": (5, "player", 320, 640, 960, 64, 32),
+    "LEVEL_DATA_CHUNK": (1024, bytes(range(256))*4, 50),
+}
+
+_sizes = {
+    "BYTE": 1, "SBYTE": 1, "SHORT": 2, "STRING": 64, "ARRAY": 1024, "INT": 4
+}
+
+def legacy_encode(fmt, *args):
+    if len(args) != len(fmt.content): return
+
+    packet = b''
+    for f, a in zip(fmt.content, args):
+        if   f == "BYTE":   packet += bytes([a & 0xff])
+        elif f == "SBYTE":  packet += encint(a, 1)
+        elif f == "SHORT":  packet += encint(a&0xffff, 2)
+        elif f == "STRING":
+            s = a[:64].encode('us-ascii')
+            packet += s + bytes([0x20 for x in range(64-len(s))])
+        elif f == "ARRAY":  packet += a[:1024]
+        elif f == "INT":    packet += encint(a, 4)
+    return packet
+
+def legacy_decode(fmt, packet):
+    if len(fmt) != len(packet): return
+
+    args = []
+    for f in fmt.content:
+        if   f == "BYTE":   args.append(packet[0])
+        elif f == "SBYTE":  args.append(decint(packet[:1]))
+        elif f == "SHORT":  args.append(decint(packet[:2]))
+        elif f == "STRING":
+            args.append(packet[:64].decode('us-ascii').strip())
+        elif f == "ARRAY":  args.append(packet[:1024])
+        elif f == "INT":    args.append(decint(packet[:4]))
+
+        packet = packet[_sizes[f]:]
+
+    return args
+
+def rate(fn, n):
+    return n / timeit.timeit(fn, number = n) / 1000
+
+def main(n = 200000):
+    print(f"{'packet':<18}{'decode/s before -> after':>25}"
+          f"{'encode/s before -> after':>32}")
+    for name, args in samples.items():
+        fmt = packet_id_s[find_packet_id(name)]
+        data = encode_packet(fmt, *args)
+        assert legacy_encode(fmt, *args) == data
+        assert list(legacy_decode(fmt, data)) == \
+            list(decode_packet(fmt, data))
+        dec = (rate(lambda: legacy_decode(fmt, data), n),
+               rate(lambda: decode_packet(fmt, data), n))
+        enc = (rate(lambda: legacy_encode(fmt, *args), n),
+               rate(lambda: encode_packet(fmt, *args), n))
+        print(f"{name:<18}{dec[0]:>13.0f}k -> {dec[1]:>6.0f}k"
+              f"{enc[0]:>20.0f}k -> {enc[1]:>6.0f}k")
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
@@ -0,0 +1,50 @@
+"""
+Benchmark of :class:`pyclassic.queue.ThreadedQueue` draining a cuboid
+queue with no delay, sent by two clients whose `set_block` does
+nothing. For reference, the same queue is also drained by popping the
+blocks off the front of a list like the queue used to.
+
+Usage::
+
+    python benchmarks/bench_queue.py [blocks ...]
+"""
+import sys, time
+from pyclassic.queue import BlockQueue, ThreadedQueue
+
+class NullClient:
+    def set_block(self, x, y, z, bid): pass
+
+def cuboid(n):
+    side = round(n ** (1/3)) or 1
+    q = BlockQueue()
+    for i in range(n):
+        q.add(i % side, i // side // side, i // side % side, 1)
+    return q
+
+def drain_cursor(q):
+    tq = ThreadedQueue([NullClient(), NullClient()], delay = 0)
+    tq.add_queue(q)
+    start = time.perf_counter()
+    tq.do_all_blockqueues()
+    return time.perf_counter() - start
+
+def drain_pop(q):
+    bots = [NullClient(), NullClient()]
+    blocks = list(zip(q.x, q.y, q.z, q.bid))
+    start = time.perf_counter()
+    bot_id = 0
+    while blocks:
+        bots[bot_id].set_block(*blocks.pop(0))
+        bot_id = (bot_id+1) % len(bots)
+    return time.perf_counter() - start
+
+def main(sizes = (100000, 200000, 400000)):
+    print(f"{'blocks':>8}{'pop(0)':>12}{'cursor':>12}")
+    for n in sizes:
+        q = cuboid(n)
+        before, after = drain_pop(q), drain_cursor(q)
+        print(f"{n:>8}{before:>11.2f}s{after:>11.2f}s"
+              f"   {n/after/1e6:.2f}M blocks/s")
+
+if __name__ == "__main__":
+    main([int(x) for x in sys.argv[1:]] or (100000, 200000, 400000))
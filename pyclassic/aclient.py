@@ -0,0 +1,158 @@
+"""
+This module contains the asyncio flavour of
+:class:`pyclassic.client.Client`. It speaks the same protocol but
+never blocks the event loop: connecting, receiving and sending
+packets are all done through asyncio streams.
+
+It is useful if you want to run event handlers, timers or even
+multiple bots in the same asyncio loop without threads. Give it to
+:class:`pyclassic.PyClassic` and the event loop will use it
+automatically.
+
+.. note::
+    The helpers inherited from :class:`pyclassic.client.Client` such
+    as :func:`move` or :func:`set_block` only write into the stream
+    buffer. Await :func:`pyclassic.aclient.AsyncClient.drain` if you
+    want to wait for the data to be actually sent.
+"""
+import asyncio, functools
+from .utils import *
+from .client import Client
+from .auth import SimpleAuth
+
+class AsyncClient(Client):
+    """
+    Asynchronous client class
+
+    :param auth: Authentication class to connect the client to a server.
+    :param client_name: Client name, see
+                        :class:`pyclassic.client.Client`
+
+    :type auth: pyclassic.auth.SimpleAuth
+    :type client_name: str or None, optional
+    """
+    def __init__(self, auth: SimpleAuth, client_name = None):
+        super().__init__(auth, client_name)
+        # The stream reader does its own buffering.
+        self.rbuffer = self.rview = None
+        self.reader = None
+        self.writer = None
+
+    async def recv(self):
+        """
+        Receives a packet and decodes it appropriately.
+
+        :raise pyclassic.utils.PyClassicError: no more data is received.
+        :raise pyclassic.utils.PyClassicError: Invalid packet.
+        :return: packet information and the decoded packet
+                 (without the packet ID as there is packet info)
+        :rtype:  (:class:`pyclassic.utils.PacketFormat`, list)
+        """
+        if not self.reader:
+            raise PyClassicError("Bot is disconnected.")
+        try:
+            packet_id = (await self.reader.readexactly(1))[0]
+            packet_info = packet_id_s.get(packet_id)
+            if not packet_info:
+                raise PyClassicError("Invalid packet.")
+            data = await self.reader.readexactly(len(packet_info))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.disconnect()
+            raise PyClassicError("no more data, disconnected.")
+
+        if self.decode is not None and not self.decode[packet_id]:
+            return packet_info, None
+        return packet_info, packet_info.codec.unpack_from(data)
+
+    def recv_many(self):
+        """
+        Not available on the asynchronous client, packets are already
+        buffered by the stream reader.
+        See :func:`pyclassic.aclient.AsyncClient.recv`
+
+        :raise pyclassic.utils.PyClassicError: always.
+        """
+        raise PyClassicError("Use AsyncClient.recv with asyncio.")
+
+    def send(self, pid, *args):
+        """
+        Sends a packet to the server. The packet is written in the
+        stream buffer and sent in the background, this function never
+        blocks.
+
+        :param pid: Packet ID
+        :param args: arguments
+
+        :type pid: int
+
+        :raise pyclassic.utils.PyClassicError: Invalid packet.
+        """
+        fmt = packet_id_c.get(pid)
+        packet = fmt and encode_packet(fmt, *args)
+        if not packet:
+            raise PyClassicError("Invalid send packet.")
+        if self.writer:
+            self.writer.write(bytes([pid]) + packet)
+        else:
+            raise PyClassicError("Bot is disconnected.")
+
+    def flush(self):
+        """
+        Does nothing, the stream writer already takes care of
+        buffering and sending the data.
+        See :func:`pyclassic.aclient.AsyncClient.drain`
+        """
+
+    async def drain(self):
+        """
+        Waits until the stream buffer has been flushed enough. Use it
+        after sending a lot of packets to respect flow control.
+        """
+        if self.writer:
+            await self.writer.drain()
+
+    async def connect(self, **kargs):
+        """
+        Connects to a server without blocking the event loop.
+        The auth object is queried in an executor as it may do HTTP
+        requests.
+
+        See :func:`pyclassic.client.Client.connect`
+
+        :raise pyclassic.utils.PyClassicError: Failed to connect.
+        :raise pyclassic.utils.PyClassicError: Kicked from server on
+                                               connect.
+
+        :return: Server information or None
+        :rtype:  (str, str) or None
+        """
+        if self.writer:
+            self.disconnect()
+
+        loop = asyncio.get_running_loop()
+        ip, port, username, mppass = await loop.run_in_executor(
+            None, functools.partial(self.auth.connect, **kargs))
+
+        self.reader, self.writer = await asyncio.open_connection(ip, port)
+        self.socket = self.writer.get_extra_info('socket')
+        self.send(0x0, 7, username, mppass, 0x42)
+
+        # The first packet is always decoded
+        decode, self.decode = self.decode, None
+        try:
+            pid, auth_or_cpe = await self.recv()
+        finally:
+            self.decode = decode
+        return self.handshake(pid, auth_or_cpe)
+
+    def disconnect(self):
+        """
+        Disconnects the client if it's connected to a server,
+        otherwise does a great amount of nothing.
+        """
+        if self.writer:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+        self.socket = None
+        self.position = None
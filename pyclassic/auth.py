@@ -1,8 +1,206 @@
 """
 This module contains some classes useful in authentication.
+
+The responses of the ClassiCube API (authentication state and server
+list) are cached for a few seconds and shared by every
+:class:`ClassiCubeAuth` using the same session, so connecting many
+bots with the same account only queries the API once.
+
+Example::
+
+    auth = ClassiCubeAuth("username", "password")
+    # Same account, same session: no login and a shared cache
+    bots = [PyClassic(ClassiCubeAuth("username", session = auth.session))
+            for _ in range(20)]
 """
 from pyclassic.utils import *
+import threading, time, weakref
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+#: Fields of the servers that are indexed by :class:`APICache`.
+indexed_fields = ('name', 'ip', 'port', 'hash')
+
+def make_session(pool_size = 16):
+    """
+    Creates a HTTP session for the ClassiCube API. Connections are
+    kept alive and pooled, idempotent requests are retried on
+    connection errors and server errors.
+
+    :param pool_size: Maximum amount of connections kept per host
+    :type pool_size:  int, optional
+
+    :rtype: :class:`requests.Session`
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections = 4, pool_maxsize = pool_size,
+        max_retries = Retry(total = 3, backoff_factor = 0.2,
+                            status_forcelist = (500, 502, 503, 504),
+                            allowed_methods = frozenset(('GET',))))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+class APICache:
+    """
+    Cache of the authentication state and the server list of a
+    session, used internally by :class:`ClassiCubeAuth`. Responses are
+    kept `ttl` seconds and the servers are indexed by name, IP, port
+    and hash. Every method can be given its own TTL, so users of the
+    same session can have different TTLs without affecting each
+    other.
+
+    It is thread-safe: if many threads need the server list at the
+    same time, only one of them queries the API.
+
+    :param session: Session used for the requests
+    :param ttl:     Time to live of the responses, in seconds
+
+    :type session: :class:`requests.Session`
+    :type ttl:     float, optional
+    """
+    def __init__(self, session, ttl = 30):
+        self.session = session
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.authenticated = None
+        self.auth_time = None
+        self.servers = None
+        self.servers_time = None
+        #: {field: {value: [server index]}}
+        self.index = {}
+
+    def fresh(self, stamp, ttl = None):
+        """
+        Used internally.
+        """
+        if ttl is None: ttl = self.ttl
+        return stamp is not None and time.monotonic() - stamp < ttl
+
+    def invalidate(self):
+        """
+        Forgets the cached responses.
+        """
+        with self.lock:
+            self.auth_time = self.servers_time = None
+
+    def check_auth(self, ttl = None):
+        """
+        :param ttl: Maximum age of the cached state, `ttl` if None
+        :type ttl:  float or None, optional
+
+        :return: Authentication state, see
+                 :func:`pyclassic.auth.ClassiCubeAuth.check_auth`
+        :rtype:  bool or None
+        """
+        with self.lock:
+            if not self.fresh(self.auth_time, ttl):
+                login = self.session.get(api_url('/login'))
+                if login.status_code != 200:
+                    return None
+                self.authenticated = login.json().get('authenticated')
+                self.auth_time = time.monotonic()
+            return self.authenticated
+
+    def server_list(self, ttl = None):
+        """
+        :param ttl: Maximum age of the cached list, `ttl` if None
+        :type ttl:  float or None, optional
+
+        :raise pyclassic.PyClassicError: User is not authenticated.
+        :return: Server list, see
+                 :func:`pyclassic.auth.ClassiCubeAuth.server_list`
+        :rtype:  list[dict]
+        """
+        with self.lock:
+            if self.fresh(self.servers_time, ttl):
+                return self.servers
+        if not self.check_auth(ttl):
+            raise PyClassicError("User is not authenticated.")
+
+        with self.lock:
+            if not self.fresh(self.servers_time, ttl):
+                self.fetch_servers()
+            return self.servers
+
+    def fetch_servers(self):
+        """
+        Fetches the server list and indexes it. Must be called with
+        the lock held. Used internally.
+        """
+        servers = self.session.get(api_url("/servers"))
+        servers = servers.json().get('servers') or []
+        index = {f: {} for f in indexed_fields}
+        for i, server in enumerate(servers):
+            for f in indexed_fields:
+                if f in server:
+                    index[f].setdefault(server[f], []).append(i)
+        self.servers, self.index = servers, index
+        self.servers_time = time.monotonic()
+
+    def refresh(self, seen):
+        """
+        Fetches the server list again, unless it has already been
+        fetched again since a given time (by another user of the
+        session). The current list stays usable in the meantime.
+
+        :param seen: :attr:`servers_time` of the list that is outdated
+        :type seen:  float or None
+        """
+        with self.lock:
+            if self.servers_time == seen:
+                self.fetch_servers()
+
+    def find(self, query, ttl = None):
+        """
+        Finds the servers matching a query, see
+        :func:`pyclassic.utils.contains_all`. Indexed fields are looked
+        up, the other ones are compared.
+
+        :param query: Server fields and their values
+        :param ttl: Maximum age of the cached list, `ttl` if None
+
+        :type query: dict
+        :type ttl:   float or None, optional
+
+        :return: Matching servers, in the order of the server list
+        :rtype:  list[dict]
+        """
+        servers = self.server_list(ttl)
+        with self.lock:
+            candidates = None
+            for f in indexed_fields:
+                if f not in query: continue
+                try:
+                    found = self.index[f].get(query[f], ())
+                except TypeError:
+                    # Unhashable value: compared by contains_all.
+                    continue
+                candidates = set(found) if candidates is None \
+                    else candidates.intersection(found)
+            if candidates is None:
+                candidates = range(len(servers))
+            else:
+                candidates = sorted(candidates)
+            return [servers[i] for i in candidates
+                    if contains_all(query, servers[i])]
+
+# {session: APICache}
+_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+def get_cache(session):
+    """
+    :return: The API cache shared by every user of a session
+    :rtype:  :class:`pyclassic.auth.APICache`
+    """
+    with _caches_lock:
+        cache = _caches.get(session)
+        if cache is None:
+            cache = _caches[session] = APICache(session)
+        return cache
 
 class SimpleAuth:
     """
@@ -51,28 +249,40 @@ class ClassiCubeAuth(SimpleAuth):
         make sure to not expose your creds lol
 
     :param username: Username of the ClassiCube account
-    :param password: Password of the ClassiCube account
+    :param password: Password of the ClassiCube account, not needed
+                     if a session is given
+    :param session: Session of the same account that is already
+                    logged in, its cached responses are shared
+    :param ttl: How long the server list and the authentication
+                state are cached, in seconds
 
     :type username: str
-    :type password: str
+    :type password: str or None, optional
+    :type session: :class:`requests.Session` or None, optional
+    :type ttl: float or None, optional
     """
-    def __init__(self, username, password):
-        self.session = self.get_session(username, password)
+    def __init__(self, username, password = None, session = None,
+                 ttl = None):
+        if session is None:
+            session = self.get_session(username, password)
+        self.session = session
         self.username = username
+        self.cache = get_cache(session)
+        #: How long cached responses are used by this instance, the
+        #: cache default if None.
+        self.ttl = ttl
 
     def check_auth(self):
         """
         Function mostly used internally to check if the user is
-        authenticated to ClassiCube.
+        authenticated to ClassiCube. The result is cached, see
+        :class:`pyclassic.auth.APICache`.
 
         :return: True if the user is authenticated, otherwise False.
                  However if the status code is not 200, it returns None.
         :rtype: bool or None
         """
-        login = self.session.get(api_url('/login'))
-        if login.status_code != 200: return None
-        login_content = login.json()
-        return login_content.get('authenticated')
+        return self.cache.check_auth(self.ttl)
 
     def get_session(self, username, password):
         """
@@ -91,7 +301,7 @@ class ClassiCubeAuth(SimpleAuth):
         :return: Session
         :rtype: :class:`requests.Session`
         """
-        session = requests.Session()
+        session = make_session()
         token = session.get(api_url("/login"))
         assert token.status_code == 200, "Login did not return OK"
         token = token.json().get('token')
@@ -120,18 +330,15 @@ class ClassiCubeAuth(SimpleAuth):
 
     def server_list(self):
         """
-        Retrieves the server list.
+        Retrieves the server list. The list is cached, see
+        :class:`pyclassic.auth.APICache`.
 
         :raise pyclassic.PyClassicError: User is not authenticated.
 
         :return: JSON response from the ClassiCube API
-        :rtype: dict
+        :rtype: list[dict]
         """
-        if not self.check_auth():
-            raise PyClassicError("User is not authenticated.")
-
-        servers = self.session.get(api_url("/servers"))
-        return servers.json().get('servers')
+        return self.cache.server_list(self.ttl)
 
     def connect(self, **kargs):
         """
@@ -152,9 +359,13 @@ class ClassiCubeAuth(SimpleAuth):
                  (see :func:`pyclassic.auth.SimpleAuth.connect`)
         :rtype:  (str, int, str, str)
         """
-        serverlist = self.server_list()
-        server = [x for x in serverlist
-                  if contains_all(kargs, x)]
+        server = self.cache.find(kargs, self.ttl)
+        if not server or not server[0].get('mppass'):
+            # The cached list may be outdated: fetch it again, the
+            # other users of the session keep using the current one
+            # until the new one replaces it.
+            self.cache.refresh(self.cache.servers_time)
+            server = self.cache.find(kargs, self.ttl)
         if len(server) == 0:
             raise PyClassicError("Server not found")
         server = server[0]
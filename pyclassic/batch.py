@@ -17,7 +17,7 @@ class Batch:
     fn: dict
     filterfn: dict
 
-    current_queue = []
+    current_queue = None
 
     def execute_line(self, line):
         cmd = line[0]
@@ -28,7 +28,7 @@ class Batch:
             self.current_queue += self.fn[cmd](*args)
         elif cmd in self.filterfn:
             f = self.filterfn[cmd](*args)
-            self.current_queue = list(filter(f, self.current_queue))
+            self.current_queue = self.current_queue.filter(f)
         else:
             raise BatchError("Invalid command.")
 
@@ -43,9 +43,9 @@ class Batch:
         :type oz: int, optional
 
         :return: The generated queue
-        :rtype: list[:class:`pyclassic.queue.Block`]
+        :rtype: :class:`pyclassic.queue.BlockQueue`
         """
-        self.current_queue = []
+        self.current_queue = pyclassic.queue.BlockQueue()
         script = [x.split() for x in script.split('\n')
                   if x.strip() != '']
 
@@ -53,10 +53,7 @@ class Batch:
             if line[0].startswith("#"): continue
             self.execute_line(line)
 
-        for block in self.current_queue:
-            block.x += ox
-            block.y += oy
-            block.z += oz
+        self.current_queue.shift(ox, oy, oz)
 
         return self.current_queue
 
@@ -69,8 +66,10 @@ class DefaultBatchFunctions:
     def cuboid(ax, ay, az, bx, by, bz, bid):
         return pyclassic.extra.cuboid(ax,ay,az,bx,by,bz,bid)
     def wall(ax, ay, az, bx, by, bz, bid):
-        return sum([pyclassic.extra.hollow(y, ax, az, bx, bz, bid)
-                    for y in range(ay, by+1)], [])
+        queue = pyclassic.queue.BlockQueue()
+        for y in range(ay, by+1):
+            queue += pyclassic.extra.hollow(y, ax, az, bx, bz, bid)
+        return queue
 
     def filter_block(b):
         return lambda block: block.bid != b
@@ -8,10 +8,16 @@ you want to. However you won't have the event system obviously.
 This class allows the connection and packet handling as well as some
 additional methods to make programming easier.
 """
-import pyclassic, socket
+import pyclassic, socket, threading, time
+from contextlib import contextmanager
 from .utils import *
 from .auth import SimpleAuth
 
+# Biggest packet that can be received, packet ID included.
+_max_packet_size = 1 + max(len(x) for x in packet_id_s.values())
+# Biggest packet that can be sent, packet ID included.
+_max_send_size = 1 + max(len(x) for x in packet_id_c.values())
+
 class Client:
     """
     Client class
@@ -20,11 +26,22 @@ class Client:
     :param client_name: Client name, can be changed as you wish but
                         defaults to `"pyclassic <VERSION>"`. Can be
                         useful sometimes :troll:
+    :param buffer_size: Size of the receive buffer in bytes.
+    :param flush_size: Outgoing packets are buffered until there are
+                       at least this many bytes to send. 0 sends every
+                       packet right away.
+    :param flush_interval: If set, buffered packets are never kept
+                           longer than this amount of seconds.
 
     :type auth: pyclassic.auth.SimpleAuth
     :type client_name: str or None, optional
+    :type buffer_size: int, optional
+    :type flush_size: int, optional
+    :type flush_interval: float or None, optional
     """
-    def __init__(self, auth: SimpleAuth, client_name = None):
+    def __init__(self, auth: SimpleAuth, client_name = None,
+                 buffer_size = 65536, flush_size = 0,
+                 flush_interval = None):
         self.auth = auth
         self.socket = None
         if not client_name:
@@ -32,6 +49,81 @@ class Client:
         else:
             self.client_name = client_name
 
+        #: Reach distance in blocks. If set, :func:`set_block` only
+        #: teleports the client when the block is out of reach.
+        self.reach = None
+        #: Last position the client has been teleported to, in blocks.
+        self.position = None
+        #: If set, one boolean per packet ID telling if the packet
+        #: must be decoded. The fields of the other packets are
+        #: skipped and received as None.
+        self.decode = None
+
+        # Receive buffer, incoming data is read in large chunks into
+        # it and packets are decoded straight from the memoryview.
+        # Start and end are the boundaries of the unparsed data.
+        self.rbuffer = bytearray(max(buffer_size, 2*_max_packet_size))
+        self.rview = memoryview(self.rbuffer)
+        self.rstart = 0
+        self.rend = 0
+
+        # Write buffer, packets are encoded straight into it and sent
+        # with a single system call when flushed.
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.wbuffer = bytearray(flush_size + 4*_max_send_size)
+        self.wview = memoryview(self.wbuffer)
+        self.wlen = 0
+        self.wtime = 0
+        self.wlock = threading.RLock()
+        self.hold = 0
+        self.timer = None
+
+    def fill_buffer(self):
+        """
+        Reads as much data as possible from the socket into the
+        receive buffer with a single system call. Used internally.
+
+        :raise pyclassic.utils.PyClassicError: no more data is received.
+        """
+        if self.rstart == self.rend:
+            self.rstart = self.rend = 0
+        elif len(self.rbuffer) - self.rend < _max_packet_size:
+            # Not enough room for a full packet at the end, move the
+            # leftover to the beginning of the buffer.
+            size = self.rend - self.rstart
+            self.rview[:size] = self.rview[self.rstart:self.rend]
+            self.rstart, self.rend = 0, size
+
+        n = self.socket.recv_into(self.rview[self.rend:])
+        if not n:
+            self.disconnect()
+            raise PyClassicError("no more data, disconnected.")
+        self.rend += n
+
+    def parse_buffer(self):
+        """
+        Decodes the next packet in the receive buffer if it has been
+        completely received. Used internally.
+
+        :raise pyclassic.utils.PyClassicError: Invalid packet.
+        :return: See :func:`pyclassic.client.Client.recv`, or None
+                 if the packet is not complete yet.
+        """
+        start = self.rstart
+        if start == self.rend: return None
+        packet_info = packet_id_s.get(self.rbuffer[start])
+        if not packet_info:
+            raise PyClassicError("Invalid packet.")
+        end = start + 1 + len(packet_info)
+        if end > self.rend: return None
+
+        self.rstart = end
+        if self.decode is not None and not self.decode[packet_info.pid]:
+            return packet_info, None
+        return packet_info, packet_info.codec.unpack_from(self.rview,
+                                                          start + 1)
+
     def recv(self):
         """
         Receives a packet and decodes it appropriately.
@@ -41,27 +133,37 @@ class Client:
                  (without the packet ID as there is packet info)
         :rtype:  (:class:`pyclassic.utils.PacketFormat`, list)
         """
-        s = self.socket
-        data = s.recv(1)
-        if not data:
-            self.disconnect()
-            raise PyClassicError("no more data, disconnected.")
-        elif len(data) != 1: return
-        packet_id = data[0]
-        packet_info = packet_id_s.get(packet_id)
-        if not packet_info:
-            raise PyClassicError("Invalid packet.")
-        psize = len(packet_info)
-        if psize == 0: return packet_info, []
-        data = b''
-        while len(data) < len(packet_info):
-            data += s.recv(len(packet_info) - len(data))
+        packet = self.parse_buffer()
+        while not packet:
+            self.fill_buffer()
+            packet = self.parse_buffer()
+        return packet
 
-        return packet_info, decode_packet(packet_info, data)
+    def recv_many(self):
+        """
+        Receives and decodes every packet available. It waits for
+        data only if the receive buffer does not contain a complete
+        packet, then yields all the complete packets it got. Useful
+        to process a whole batch of packets per wake up.
+
+        :raise pyclassic.utils.PyClassicError: no more data is received.
+        :return: Iterator of packets,
+                 see :func:`pyclassic.client.Client.recv`
+        :rtype:  iterator[(:class:`pyclassic.utils.PacketFormat`, list)]
+        """
+        packet = self.parse_buffer()
+        while not packet:
+            self.fill_buffer()
+            packet = self.parse_buffer()
+        while packet:
+            yield packet
+            packet = self.parse_buffer()
 
     def send(self, pid, *args):
         """
-        Sends a packet to the server.
+        Sends a packet to the server. The packet is encoded in the
+        write buffer and sent according to `flush_size` and
+        `flush_interval`, right away by default.
 
         :param pid: Packet ID
         :param args: arguments
@@ -70,14 +172,98 @@ class Client:
 
         :raise pyclassic.utils.PyClassicError: Invalid packet.
         """
-        packet = encode_packet(packet_id_c[pid], *args)
-        if not packet:
+        fmt = packet_id_c.get(pid)
+        if not fmt or len(args) != fmt.codec.fields:
             raise PyClassicError("Invalid send packet.")
-        if self.socket:
-            self.socket.sendall(bytes([pid]) + packet)
-        else:
+        if not self.socket:
             raise PyClassicError("Bot is disconnected.")
- 
+
+        size = 1 + len(fmt)
+        with self.wlock:
+            if self.wlen + size > len(self.wbuffer):
+                self.send_buffer()
+            fmt.codec.pack_into(self.wbuffer, self.wlen + 1, *args)
+            self.wbuffer[self.wlen] = pid
+            if not self.wlen:
+                self.wtime = time.monotonic()
+            self.wlen += size
+            if not self.hold:
+                self.check_flush()
+
+    def send_many(self, packets):
+        """
+        Sends a bunch of packets at once, with a single system call if
+        they fit in the write buffer.
+
+        :param packets: Packets as tuples of the packet ID followed by
+                        the arguments, like `(0xd, 0xff, "hi")`.
+        :type packets:  iterable[tuple]
+
+        :raise pyclassic.utils.PyClassicError: Invalid packet.
+        """
+        with self.batch():
+            for pid, *args in packets:
+                self.send(pid, *args)
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager that holds every packet sent inside of it in
+        the write buffer until the end, then flushes them all together
+        (as long as `flush_size` or `flush_interval` allow it). ::
+
+            with client.batch():
+                client.move(x, y, z)
+                client.message("hi")
+        """
+        with self.wlock:
+            self.hold += 1
+        try:
+            yield self
+        finally:
+            with self.wlock:
+                self.hold -= 1
+                if not self.hold:
+                    self.check_flush()
+
+    def flush(self):
+        """
+        Sends everything that is in the write buffer.
+        """
+        with self.wlock:
+            self.send_buffer()
+
+    def check_flush(self):
+        """
+        Flushes the write buffer if it is big or old enough, otherwise
+        makes sure it will be flushed in time. Used internally, the
+        write lock must be held.
+        """
+        if not self.wlen: return
+        if self.wlen >= self.flush_size or (
+                self.flush_interval is not None and
+                time.monotonic() - self.wtime >= self.flush_interval):
+            self.send_buffer()
+        elif self.flush_interval is not None and not self.timer:
+            self.timer = threading.Timer(self.flush_interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def send_buffer(self):
+        """
+        Sends the write buffer. Used internally, the write lock must
+        be held.
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.wlen: return
+        try:
+            if self.socket:
+                self.socket.sendall(self.wview[:self.wlen])
+        finally:
+            self.wlen = 0
+
     def connect(self, **kargs):
         """
         Connects to a server. Will use the specified
@@ -106,12 +292,35 @@ class Client:
         ip, port, username, mppass = self.auth.connect(**kargs)
         
         self.socket = s
+        self.rstart = self.rend = 0
+        self.wlen = 0
         s.connect((ip, port))
         s.sendall(b'\x00' + encode_packet(packet_id_c[0x0], 7,
                                           username, mppass, 0x42)) ##TODO: make 0x42 configurable (cpe on or off)
 
-        pid, auth_or_cpe = self.recv()
+        # The first packet is always decoded
+        decode, self.decode = self.decode, None
+        try:
+            pid, auth_or_cpe = self.recv()
+        finally:
+            self.decode = decode
+        return self.handshake(pid, auth_or_cpe)
 
+    def handshake(self, pid, auth_or_cpe):
+        """
+        Handles the first packet sent by the server on connection.
+        Used internally by :func:`pyclassic.client.Client.connect`.
+
+        :param pid: Packet information of the first packet
+        :param auth_or_cpe: Decoded first packet
+
+        :raise pyclassic.utils.PyClassicError: Failed to connect.
+        :raise pyclassic.utils.PyClassicError: Kicked from server on
+                                               connect.
+
+        :return: Server information or None
+        :rtype:  (str, str) or None
+        """
         if not auth_or_cpe:
             self.disconnect()
             raise PyClassicError("Failed to connect to server.")
@@ -137,10 +346,17 @@ class Client:
         """
         Disconnects the client if it's connected to a server,
         otherwise does a great amount of nothing.
+        Buffered packets are sent before.
         """
         if self.socket:
+            try:
+                self.flush()
+            except OSError:
+                pass
             self.socket.close()
             self.socket = None
+        # Unknown until the server spawns the client again.
+        self.position = None
 
     def message(self, message):
         """
@@ -188,11 +404,30 @@ class Client:
         :type yaw:   int, optional
         """
         self.send(0x8, -1, x, y, z, pitch, yaw)
+        self.position = (x/32, y/32, z/32)
         
 
+    def in_reach(self, x, y, z):
+        """
+        Checks if a block can be reached from the last position the
+        client has been teleported to. Always false if
+        :attr:`reach` is not set.
+
+        :type x: int
+        :type y: int
+        :type z: int
+        :rtype: bool
+        """
+        if self.reach is None or self.position is None:
+            return False
+        px, py, pz = self.position
+        return (x-px)**2 + (y-py)**2 + (z-pz)**2 <= self.reach**2
+
     def set_block(self, x, y, z, block_id):
         """
-        Make the client place a block at a specified position.
+        Make the client place a block at a specified position. The
+        client is teleported next to the block first, unless it is
+        already in reach (see :attr:`reach`).
 
         .. note::
             Abuse this and you'll get kicked lmao.
@@ -202,8 +437,10 @@ class Client:
         :type z: int
         :type block_int: int
         """
-        self.move(x-1, y, z)
-        self.send(5, x, y, z, 1, block_id)
+        with self.batch():
+            if not self.in_reach(x, y, z):
+                self.move(x-1, y, z)
+            self.send(5, x, y, z, 1, block_id)
         """
         if self.map:
             self.map[x, y, z] = block_id
@@ -0,0 +1,414 @@
+"""
+This module contains the event handler registry used by
+:class:`pyclassic.PyClassic`.
+
+Events are either packet IDs (for `on_packet_*` events) or names such
+as `"recv"` or `"set_block"`. Any amount of handlers can be registered
+for an event, they run by decreasing priority then in the order they
+were added.
+
+Handlers of packet events are also stored in a table indexed by packet
+ID, rebuilt only when handlers are added or removed, so finding the
+handlers of a received packet is a single list lookup.
+
+Every time an event is fired, its handlers are called one after the
+other in a single task: a handler only starts once the previous one
+has returned (or its coroutine has finished). Handlers of the same
+event used to run concurrently, use separate events (or spawn tasks
+from a handler) if that matters.
+
+By default there is no limit on the amount of running tasks, but
+every event can have a policy (see :class:`EventPolicy`) limiting
+them: extra events then wait, replace older ones or are coalesced.
+Exceptions raised by handlers are given to an error hook and every
+event has statistics (see :class:`EventStats`).
+
+Example::
+
+    # Only one task per player for movements, the latest one wins.
+    events.set_policy("move", EventPolicy(
+        max_in_flight = 1, overflow = "coalesce",
+        key = lambda args: args[1]))
+"""
+import asyncio, inspect, itertools, time, traceback
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping
+from dataclasses import dataclass
+
+class EventError(Exception): pass
+
+_overflows = ("wait", "drop_oldest", "coalesce")
+
+@dataclass
+class EventPolicy:
+    """
+    How the handlers of an event are scheduled.
+
+    :param max_in_flight: Maximum amount of running tasks of the
+                          event, unlimited if None.
+    :param overflow: What happens to an event fired while
+                     `max_in_flight` tasks are running.
+                     `"wait"` queues it and the event loop stops
+                     receiving packets until every queued event has
+                     started. `"drop_oldest"` queues up to
+                     `max_pending` events, dropping the oldest ones.
+                     `"coalesce"` only keeps the latest queued event of
+                     every key.
+    :param max_pending: Size of the queue with `"drop_oldest"`
+    :param key: Function giving the key of an event from its arguments
+                with `"coalesce"`, all the events have the same key if
+                None.
+
+    :type max_in_flight: int or None, optional
+    :type overflow: str, optional
+    :type max_pending: int, optional
+    :type key: function or None, optional
+    """
+    max_in_flight: int = None
+    overflow: str = "wait"
+    max_pending: int = 64
+    key: object = None
+
+@dataclass
+class EventStats:
+    """
+    Statistics of an event.
+    """
+    #: Times the event has been fired
+    fired: int = 0
+    #: Tasks that are done
+    completed: int = 0
+    #: Exceptions raised by the handlers
+    errors: int = 0
+    #: Events dropped by `"drop_oldest"`
+    dropped: int = 0
+    #: Events replaced by a newer one with `"coalesce"`
+    coalesced: int = 0
+    #: Running tasks
+    in_flight: int = 0
+    #: Queued events
+    pending: int = 0
+    #: Highest amount of queued events
+    max_pending: int = 0
+    #: Total time spent queued, in seconds
+    wait_total: float = 0
+    #: Total time spent running the handlers, in seconds
+    latency_total: float = 0
+    #: Longest time spent running the handlers, in seconds
+    latency_max: float = 0
+
+    @property
+    def latency_mean(self):
+        """
+        Average time spent running the handlers, in seconds
+        """
+        return self.latency_total / self.completed if self.completed \
+            else 0
+
+class EventDispatcher:
+    """
+    Registry of event handlers.
+
+    Example::
+
+        events = EventDispatcher()
+        events.add("recv", on_recv)
+        events.add(0x0d, on_message, priority = 10)
+        for fn in events.packet_table[0x0d]:
+            ...
+    """
+    def __init__(self):
+        # {event: [(-priority, order, function)]}, kept sorted.
+        self.handlers = {}
+        self.counter = itertools.count()
+        #: Handlers of every packet ID, as tuples.
+        self.packet_table = [()] * 256
+        self.policies = {}
+        #: Statistics of every event that has been fired,
+        #: see :class:`pyclassic.events.EventStats`
+        self.stats = {}
+        # Queued events: a deque, or an OrderedDict with "coalesce".
+        self.pending = {}
+        # Futures the event loop waits on with "wait".
+        self.waiters = {}
+        self.tasks = set()
+        #: Called with the event, the handler and the exception when
+        #: a handler raises one. The traceback is printed if None.
+        self.error_hook = None
+
+    def add(self, event, fn, priority = 0):
+        """
+        Registers a handler.
+
+        :param event:    Event name or packet ID
+        :param fn:       Handler
+        :param priority: Handlers with a higher priority run first
+
+        :type event:    str or int
+        :type fn:       function
+        :type priority: int, optional
+
+        :return: The handler
+        :rtype:  function
+        """
+        handlers = self.handlers.setdefault(event, [])
+        handlers.append((-priority, next(self.counter), fn))
+        handlers.sort(key = lambda h: h[:2])
+        self.update(event)
+        return fn
+
+    def remove(self, event, fn = None):
+        """
+        Unregisters a handler, or every handler of an event.
+
+        :param event: Event name or packet ID
+        :param fn:    Handler, all of them if None
+
+        :type event: str or int
+        :type fn:    function or None, optional
+
+        :raise pyclassic.events.EventError: The handler is not
+                                            registered.
+        """
+        handlers = self.handlers.get(event, [])
+        kept = [h for h in handlers if fn is not None and h[2] != fn]
+        if fn is not None and len(kept) == len(handlers):
+            raise EventError("This handler is not registered.")
+        if kept:
+            self.handlers[event] = kept
+        else:
+            self.handlers.pop(event, None)
+        self.update(event)
+
+    def update(self, event):
+        """
+        Updates the packet table after a change. Used internally.
+        """
+        if type(event) is int:
+            self.packet_table[event] = self.get(event)
+
+    def get(self, event):
+        """
+        :param event: Event name or packet ID
+        :type event:  str or int
+
+        :return: Handlers of an event, in the order they must run
+        :rtype:  tuple[function]
+        """
+        return tuple(h[2] for h in self.handlers.get(event, ()))
+
+    def packet_ids(self):
+        """
+        :return: Packet IDs that have at least one handler
+        :rtype:  set[int]
+        """
+        return {e for e in self.handlers if type(e) is int}
+
+    def set_policy(self, event, policy = None):
+        """
+        Sets the scheduling policy of an event. Events queued by the
+        previous policy are not lost: they are scheduled again, in
+        order, with the new policy.
+
+        :param event: Event name or packet ID
+        :param policy: The policy, no limit if None
+
+        :type event: str or int
+        :type policy: :class:`pyclassic.events.EventPolicy` or None
+
+        :raise pyclassic.events.EventError: Invalid policy.
+        """
+        if policy is not None and policy.overflow not in _overflows:
+            raise EventError("Invalid overflow policy.")
+        old = self.pending.pop(event, None)
+        old = list(old.values() if isinstance(old, OrderedDict)
+                   else old or ())
+
+        if policy is None:
+            self.policies.pop(event, None)
+        else:
+            self.policies[event] = policy
+            self.pending[event] = OrderedDict() \
+                if policy.overflow == "coalesce" else deque()
+        if event in self.stats:
+            self.stats[event].pending = 0
+        for args, fired in old:
+            self.schedule(event, args, fired)
+        if not self.pending.get(event):
+            waiter = self.waiters.pop(event, None)
+            if waiter and not waiter.done():
+                waiter.set_result(None)
+
+    def fire(self, event, args):
+        """
+        Fires an event: schedules its handlers according to its
+        policy. Must be called from the asyncio loop.
+
+        :param event: Event name or packet ID
+        :param args: Arguments of the handlers
+
+        :type event: str or int
+        :type args: tuple or list
+        """
+        if type(event) is int:
+            if not self.packet_table[event]: return
+        elif event not in self.handlers:
+            return
+        stats = self.stats.get(event)
+        if not stats:
+            stats = self.stats[event] = EventStats()
+        stats.fired += 1
+        self.schedule(event, args, time.perf_counter())
+
+    def schedule(self, event, args, now):
+        """
+        Starts or queues a fired event according to its policy. Used
+        internally.
+        """
+        stats = self.stats[event]
+        policy = self.policies.get(event)
+        if not policy or policy.max_in_flight is None or \
+           stats.in_flight < policy.max_in_flight:
+            self.start(event, args, now)
+            return
+
+        pending = self.pending[event]
+        if policy.overflow == "coalesce":
+            key = policy.key(args) if policy.key else None
+            if key in pending: stats.coalesced += 1
+            pending[key] = (args, now)
+        else:
+            if policy.overflow == "drop_oldest" and \
+               len(pending) >= policy.max_pending:
+                pending.popleft()
+                stats.dropped += 1
+            pending.append((args, now))
+        stats.pending = len(pending)
+        stats.max_pending = max(stats.max_pending, stats.pending)
+
+    def start(self, event, args, fired):
+        """
+        Starts the task of an event. Used internally.
+        """
+        self.stats[event].in_flight += 1
+        task = asyncio.ensure_future(self.call(event, args, fired))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def call(self, event, args, fired):
+        """
+        Runs the handlers of an event. Used internally.
+        """
+        stats = self.stats[event]
+        start = time.perf_counter()
+        stats.wait_total += start - fired
+        try:
+            for fn in self.get(event):
+                try:
+                    result = fn(*args)
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception as e:
+                    stats.errors += 1
+                    self.report(event, fn, e)
+        finally:
+            elapsed = time.perf_counter() - start
+            stats.completed += 1
+            stats.latency_total += elapsed
+            stats.latency_max = max(stats.latency_max, elapsed)
+            stats.in_flight -= 1
+            self.next(event)
+
+    def next(self, event):
+        """
+        Starts the next queued event if there is one. Used
+        internally.
+        """
+        pending = self.pending.get(event)
+        if pending:
+            if isinstance(pending, OrderedDict):
+                args, fired = pending.popitem(last = False)[1]
+            else:
+                args, fired = pending.popleft()
+            self.stats[event].pending = len(pending)
+            self.start(event, args, fired)
+        if not pending:
+            waiter = self.waiters.pop(event, None)
+            if waiter and not waiter.done():
+                waiter.set_result(None)
+
+    def report(self, event, fn, exception):
+        """
+        Reports an exception raised by a handler. Used internally.
+        """
+        if self.error_hook:
+            try:
+                self.error_hook(event, fn, exception)
+                return
+            except Exception as e:
+                exception = e
+        traceback.print_exception(type(exception), exception,
+                                  exception.__traceback__)
+
+    async def wait_ready(self):
+        """
+        Waits until every queued event of the events with the
+        `"wait"` policy has started.
+        """
+        loop = asyncio.get_running_loop()
+        for event, policy in list(self.policies.items()):
+            if policy.overflow != "wait": continue
+            while self.pending.get(event):
+                waiter = self.waiters.get(event)
+                if not waiter:
+                    waiter = self.waiters[event] = loop.create_future()
+                await waiter
+
+    def __contains__(self, event):
+        return event in self.handlers
+
+class HandlerView(MutableMapping):
+    """
+    Dict-like view of a dispatcher with a single function per event,
+    kept for code written when events could only have one function.
+    Reading an event gives its first handler, setting an event
+    replaces all of its handlers.
+
+    :param dispatcher: The dispatcher
+    :param on_change: Called after every change, if given
+
+    :type dispatcher: :class:`pyclassic.events.EventDispatcher`
+    :type on_change: function or None, optional
+    """
+    def __init__(self, dispatcher, on_change = None):
+        self.dispatcher = dispatcher
+        self.on_change = on_change
+
+    def changed(self):
+        """
+        Used internally.
+        """
+        if self.on_change: self.on_change()
+
+    def __getitem__(self, event):
+        handlers = self.dispatcher.get(event)
+        if not handlers:
+            raise KeyError(event)
+        return handlers[0]
+
+    def __setitem__(self, event, fn):
+        self.dispatcher.remove(event)
+        self.dispatcher.add(event, fn)
+        self.changed()
+
+    def __delitem__(self, event):
+        if event not in self.dispatcher:
+            raise KeyError(event)
+        self.dispatcher.remove(event)
+        self.changed()
+
+    def __iter__(self):
+        return iter(list(self.dispatcher.handlers))
+
+    def __len__(self):
+        return len(self.dispatcher.handlers)
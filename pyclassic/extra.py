@@ -1,5 +1,9 @@
 # Cool extras.
-from pyclassic.queue import Block
+import math
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+import pyclassic.map
+from pyclassic.queue import Block, BlockQueue
 from pyclassic.client import Client
 from pyclassic.auth import SimpleAuth
 
@@ -47,26 +51,27 @@ def download_map(bot):
     :return: The downloaded, decompressed and parsed map.
     :rtype:  :class:`pyclassic.map.ClassicMap`
     """
-    m = b''
+    level = pyclassic.map.LevelAssembler()
     while True:
         info, packet = bot.recv()
         if info.pid == 3:
-            m += packet[1][:packet[0]]
+            level.feed(packet[1][:packet[0]])
         elif info.pid == 4:
             x, y, z = packet
             break
-    return pyclassic.map.ClassicMap(m, x, y, z)
+    return level.finalize(x, y, z)
 
 def hollow(y, x1, z1, x2, z2, bid):
     (ax, bx), (az, bz) = sorted((x1, x2)), sorted((z1, z2))
-    result = [Block(x, y, az, bid) for x in range(ax, bx+1)] + \
-        [Block(x, y, bz, bid) for x in range(ax, bx+1)] + \
-        [Block(ax, y, z, bid) for z in range(az, bz+1)] + \
-        [Block(bx, y, z, bid) for z in range(az, bz+1)]
+    result = BlockQueue()
+    result.extend_ranges(range(ax, bx+1), (y,), (az,), bid)
+    result.extend_ranges(range(ax, bx+1), (y,), (bz,), bid)
+    result.extend_ranges((ax,), (y,), range(az, bz+1), bid)
+    result.extend_ranges((bx,), (y,), range(az, bz+1), bid)
     return result
 
 def pyramid(size, ox, oy, oz, bid):
-    q = []
+    q = BlockQueue()
     for y in range(0, size//2):
         sz = size-y
         q += hollow(oy+y, y+ox, y+oz, sz+ox, sz+oz, bid)
@@ -76,9 +81,268 @@ def cuboid(x1, y1, z1, x2, y2, z2, blockid):
     ax, ay, az = min(x1, x2), min(y1, y2), min(z1, z2)
     bx, by, bz = max(x1, x2), max(y1, y2), max(z1, z2)
 
-    queue = []
-    for x in range(ax, bx+1):
-        for y in range(ay, by+1):
-            for z in range(az, bz+1):
-                queue.append(Block(x, y, z, blockid))
+    queue = BlockQueue()
+    queue.extend_ranges(range(ax, bx+1), range(ay, by+1),
+                        range(az, bz+1), blockid)
     return queue
+
+class Shape(ABC):
+    """
+    Base class of the shape descriptors. A shape only stores its
+    parameters and describes itself as rows of blocks along X (see
+    :func:`rows`), so its size or bounding box are computed without
+    enumerating the blocks.
+
+    Iterating a shape lazily yields :class:`pyclassic.queue.Block`
+    objects, bottom to top. It can be given as is to
+    :func:`pyclassic.queue.ThreadedQueue.add_queue` which then builds
+    it as a stream, in constant memory.
+
+    Example::
+
+        shape = Sphere(64, 64, 64, 40, 1, hollow = True)
+        len(shape)  # no block is made
+        bot.queue.add_queue(shape)
+    """
+    @abstractmethod
+    def rows(self):
+        """
+        :return: (y, z, X range) of every row of the shape
+        :rtype:  iterator[(int, int, range)]
+        """
+
+    def __iter__(self):
+        bid = self.bid
+        for y, z, xs in self.rows():
+            for x in xs:
+                yield Block(x, y, z, bid)
+
+    def __len__(self):
+        return sum(len(xs) for y, z, xs in self.rows())
+
+    def __contains__(self, pos):
+        x, y, z = pos[:3]
+        return any(y == ry and z == rz and x in xs
+                   for ry, rz, xs in self.rows())
+
+    def box(self):
+        """
+        :return: Minimum and maximum corners of the shape or None if
+                 it is empty
+        :rtype:  ((int, int, int), (int, int, int)) or None
+        """
+        rows = [r for r in self.rows() if r[2]]
+        if not rows: return None
+        return (min(xs[0] for y, z, xs in rows),
+                min(y for y, z, xs in rows),
+                min(z for y, z, xs in rows)), \
+            (max(xs[-1] for y, z, xs in rows),
+             max(y for y, z, xs in rows),
+             max(z for y, z, xs in rows))
+
+    def queues(self, size = 4096):
+        """
+        Builds the shape by parts, each part is made in bulk row by
+        row.
+
+        :param size: Minimum size of the parts (except the last one)
+        :type size:  int, optional
+
+        :return: The shape as consecutive queues
+        :rtype:  iterator[:class:`pyclassic.queue.BlockQueue`]
+        """
+        q = BlockQueue()
+        for y, z, xs in self.rows():
+            q.add_row(xs, y, z, self.bid)
+            if len(q) >= size:
+                yield q
+                q = BlockQueue()
+        if len(q): yield q
+
+    def queue(self):
+        """
+        :return: The whole shape as a queue
+        :rtype:  :class:`pyclassic.queue.BlockQueue`
+        """
+        q = BlockQueue()
+        for part in self.queues():
+            q += part
+        return q
+
+@dataclass
+class Cuboid(Shape):
+    """
+    A filled cuboid, see :func:`pyclassic.extra.cuboid`.
+    """
+    x1: int
+    y1: int
+    z1: int
+    x2: int
+    y2: int
+    z2: int
+    bid: int
+
+    def rows(self):
+        xs = range(min(self.x1, self.x2), max(self.x1, self.x2)+1)
+        for y in range(min(self.y1, self.y2), max(self.y1, self.y2)+1):
+            for z in range(min(self.z1, self.z2), max(self.z1, self.z2)+1):
+                yield y, z, xs
+
+    def __len__(self):
+        return (abs(self.x2-self.x1)+1) * (abs(self.y2-self.y1)+1) * \
+            (abs(self.z2-self.z1)+1)
+
+    def __contains__(self, pos):
+        return all(min(a, b) <= v <= max(a, b) for v, a, b in
+                   zip(pos, (self.x1, self.y1, self.z1),
+                       (self.x2, self.y2, self.z2)))
+
+@dataclass
+class Walls(Shape):
+    """
+    The four vertical walls of a cuboid, without floor and ceiling.
+    One layer of it is what :func:`pyclassic.extra.hollow` makes.
+    """
+    x1: int
+    y1: int
+    z1: int
+    x2: int
+    y2: int
+    z2: int
+    bid: int
+
+    def rows(self):
+        ax, bx = sorted((self.x1, self.x2))
+        az, bz = sorted((self.z1, self.z2))
+        for y in range(min(self.y1, self.y2), max(self.y1, self.y2)+1):
+            yield y, az, range(ax, bx+1)
+            for z in range(az+1, bz):
+                yield y, z, range(ax, ax+1)
+                if bx != ax: yield y, z, range(bx, bx+1)
+            if bz != az: yield y, bz, range(ax, bx+1)
+
+@dataclass
+class Pyramid(Shape):
+    """
+    A hollow stepped pyramid, see :func:`pyclassic.extra.pyramid`.
+    """
+    size: int
+    ox: int
+    oy: int
+    oz: int
+    bid: int
+
+    def rows(self):
+        for y in range(0, self.size//2):
+            sz = self.size - y
+            yield from Walls(y+self.ox, self.oy+y, y+self.oz,
+                             sz+self.ox, self.oy+y, sz+self.oz,
+                             self.bid).rows()
+
+def span_rows(x, y, z, outer, inner):
+    """
+    Rows of a symmetric span around x, with a hole of half width
+    `inner` (no hole if negative). Used internally.
+    """
+    if inner < 0:
+        yield y, z, range(x-outer, x+outer+1)
+    elif outer > inner:
+        yield y, z, range(x-outer, x-inner)
+        yield y, z, range(x+inner+1, x+outer+1)
+
+@dataclass
+class Sphere(Shape):
+    """
+    A sphere, made of the blocks whose distance to the center is at
+    most the radius.
+
+    :param hollow: Only keep the shell
+    """
+    x: int
+    y: int
+    z: int
+    radius: int
+    bid: int
+    hollow: bool = False
+
+    def rows(self):
+        r2 = self.radius**2
+        inner = (self.radius-1)**2
+        for dy in range(-self.radius, self.radius+1):
+            for dz in range(-self.radius, self.radius+1):
+                d2 = dy*dy + dz*dz
+                if d2 > r2: continue
+                yield from span_rows(self.x, self.y+dy, self.z+dz,
+                                     math.isqrt(r2 - d2),
+                                     math.isqrt(inner - d2)
+                                     if self.hollow and d2 <= inner
+                                     else -1)
+
+@dataclass
+class Cylinder(Shape):
+    """
+    A vertical cylinder.
+
+    :param hollow: Only keep the side
+    """
+    x: int
+    z: int
+    y1: int
+    y2: int
+    radius: int
+    bid: int
+    hollow: bool = False
+
+    def rows(self):
+        r2 = self.radius**2
+        inner = (self.radius-1)**2
+        for y in range(min(self.y1, self.y2), max(self.y1, self.y2)+1):
+            for dz in range(-self.radius, self.radius+1):
+                d2 = dz*dz
+                yield from span_rows(self.x, y, self.z+dz,
+                                     math.isqrt(r2 - d2),
+                                     math.isqrt(inner - d2)
+                                     if self.hollow and d2 <= inner
+                                     else -1)
+
+@dataclass
+class Line(Shape):
+    """
+    A line between two positions (both included), traced with the 3D
+    Bresenham algorithm.
+    """
+    x1: int
+    y1: int
+    z1: int
+    x2: int
+    y2: int
+    z2: int
+    bid: int
+
+    def points(self):
+        """
+        :return: Positions of the line, from the first position
+        :rtype:  iterator[(int, int, int)]
+        """
+        p = [self.x1, self.y1, self.z1]
+        d = [abs(b - a) for a, b in zip(p, (self.x2, self.y2, self.z2))]
+        s = [1 if b >= a else -1 for a, b in
+             zip(p, (self.x2, self.y2, self.z2))]
+        n = max(d)
+        err = [n // 2] * 3
+        yield tuple(p)
+        for _ in range(n):
+            for i in range(3):
+                err[i] -= d[i]
+                if err[i] < 0:
+                    err[i] += n
+                    p[i] += s[i]
+            yield tuple(p)
+
+    def rows(self):
+        for x, y, z in self.points():
+            yield y, z, range(x, x+1)
+
+    def __len__(self):
+        return max(abs(self.x2-self.x1), abs(self.y2-self.y1),
+                   abs(self.z2-self.z1)) + 1
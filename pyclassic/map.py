@@ -12,18 +12,51 @@ or ClassicWorld (.cw) files
     6 shorts (12 bytes) prepended. The 3 first being the offset of the map
     and the 3 last being the size of the map. All of it gzipped. It is
     quite trivial to parse.
+
+.. note::
+    There is also an uncompressed "raw" variant of the format meant
+    for big worlds (see :func:`open_raw`): a 32 bytes header made of
+    the magic `PCRAWMAP`, the 3 offset shorts and the 3 size shorts
+    (padded with zeros), followed by the blocks. Raw maps are opened
+    with `mmap`, blocks are only read from the disk when they are
+    accessed. Writes only go straight to the file if the map is opened
+    with `writable` set, otherwise they stay in memory.
+
+.. note::
+    If NumPy is installed, :class:`ClassicMap` can expose its blocks
+    as an array (see :attr:`ClassicMap.array`) and region operations
+    such as slicing, filling or counting blocks are vectorized.
+    NumPy is optional, everything falls back to pure Python.
+
+.. note::
+    Compressed maps are saved like `pigz` does (see :func:`write_gzip`):
+    the data is split in blocks deflated in parallel by a thread pool
+    and stitched together in a single gzip member, which any gzip
+    reader can decompress.
 """
 # Map stuff
-import gzip
+import gzip, zlib, mmap, os, struct, time
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from collections import Counter, deque
 import pyclassic.queue as queue
 
 from .utils import decint, encint
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class ClassicMapError(Exception): pass
 
+_raw_magic = b'PCRAWMAP'
+_raw_header_size = 32
+
 def load(filename):
     """
-    Loads a map.
+    Loads a map. Raw maps are opened with :func:`open_raw`, changes
+    made to the map are never written to the file.
 
     :param filename: File name
     :type filename:  str
@@ -31,15 +64,582 @@ def load(filename):
     :return: The offset and the generate map object.
     :rtype:  (int, int, int), :class:`pyclassic.map.ClassicMap`
     """
+    with open(filename, "rb") as f:
+        magic = f.read(len(_raw_magic))
+    if magic == _raw_magic:
+        return open_raw(filename, writable = False)
+
     with gzip.open(filename) as f:
         offset = f.read(6)
         x, y, z = [decint(offset[x:x+2]) for x in range(0,6,2)]
         size = f.read(6)
         width, height, length = [decint(size[x:x+2]) for x in range(0,6,2)]
-        data = f.read()
-    return (x, y, z), ClassicMap(data,
-                                 width, height, length,
-                                 compressed = False)
+        # Read the blocks straight into a buffer of the right size
+        data = bytearray(4 + width*height*length)
+        del data[f.readinto(data):]
+    m = ClassicMap.from_blocks(memoryview(data)[4:], width, height, length)
+    m.data = data
+    return (x, y, z), m
+
+def deflate_block(data, compresslevel, strategy, last, zdict = None):
+    """
+    Deflates a block of a gzip stream written by :func:`write_gzip`.
+    The block is sync flushed (or finished if it is the last one) so
+    that the compressed blocks can just be concatenated.
+    Used internally.
+
+    :param data: Data to compress
+    :param last: Is it the last block of the stream
+    :param zdict: Data preceding the block (up to 32 KiB) used as the
+                  dictionary to keep the compression ratio close to a
+                  sequential compression.
+
+    :rtype: bytes
+    """
+    if zdict:
+        c = zlib.compressobj(compresslevel, zlib.DEFLATED, -15, 8,
+                             strategy, zdict)
+    else:
+        c = zlib.compressobj(compresslevel, zlib.DEFLATED, -15, 8,
+                             strategy)
+    return c.compress(data) + \
+        c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def write_gzip(f, data, compresslevel = 9,
+               strategy = zlib.Z_DEFAULT_STRATEGY, workers = None,
+               block_size = 1 << 17, header = b''):
+    """
+    Writes data as a single gzip member, compressing it on multiple
+    cores. The data is split in blocks deflated in a thread pool
+    (zlib releases the GIL) while the CRC is computed, and the blocks
+    are written in order.
+
+    :param f:    File opened in binary write mode
+    :param data: Data to compress
+    :param compresslevel: zlib compression level (0-9)
+    :param strategy: zlib strategy, `zlib.Z_RLE` is much faster and
+                     compresses maps almost as well.
+    :param workers: Number of threads, the number of CPUs if None
+    :param block_size: Size of the blocks compressed independently
+    :param header: Small data compressed before `data` in the same
+                   stream, so `data` does not have to be copied to
+                   prepend it.
+
+    :type data: bytes-like object
+    :type compresslevel: int, optional
+    :type strategy: int, optional
+    :type workers: int or None, optional
+    :type block_size: int, optional
+    :type header: bytes, optional
+    """
+    data = memoryview(data).cast('B')
+    size = len(header) + len(data)
+    starts = range(0, size, block_size) or [0]
+    last = starts[-1]
+
+    f.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) +
+            (b'\x02' if compresslevel == 9 else
+             b'\x04' if compresslevel == 1 else b'\x00') + b'\xff')
+
+    def job(start):
+        return deflate_block(data[start:start+block_size], compresslevel,
+                             strategy, start == last,
+                             data[max(start-32768, 0):start])
+
+    crc = zlib.crc32(header)
+    if header:
+        f.write(deflate_block(header, compresslevel, strategy, False))
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(starts) == 1:
+        for start in starts:
+            f.write(job(start))
+            crc = zlib.crc32(data[start:start+block_size], crc)
+    else:
+        with ThreadPoolExecutor(workers) as pool:
+            # Submit ahead in a bounded window to cap memory usage
+            window = 4 * workers
+            pending = [pool.submit(job, x) for x in starts[:window]]
+            for i, start in enumerate(starts):
+                crc = zlib.crc32(data[start:start+block_size], crc)
+                if i + window < len(starts):
+                    pending.append(pool.submit(job, starts[i + window]))
+                f.write(pending[i].result())
+                pending[i] = None
+    f.write(struct.pack('<II', crc, size & 0xffffffff))
+
+def read_raw_header(f):
+    """
+    Reads the header of a raw map. Used internally.
+
+    :raise pyclassic.map.ClassicMapError: Not a raw map.
+    :return: offset and size
+    :rtype:  (int, int, int), (int, int, int)
+    """
+    header = f.read(_raw_header_size)
+    if header[:len(_raw_magic)] != _raw_magic:
+        raise ClassicMapError("Not a raw map.")
+    values = [decint(header[x:x+2]) for x in range(8, 20, 2)]
+    return tuple(values[:3]), tuple(values[3:])
+
+def open_raw(filename, writable = False):
+    """
+    Opens a raw map with `mmap`. Opening is instant whatever the size
+    of the map as blocks are only paged in when they are accessed. If
+    the map is writable, changes are written to the file, otherwise
+    they are only kept in memory (copy-on-write).
+
+    Close the map (:func:`ClassicMap.close`) when you are done with
+    it, it can be used as a context manager::
+
+        with open_raw("world.raw", True)[1] as themap:
+            themap[1, 2, 3] = 1
+
+    See :func:`pyclassic.map.ClassicMap.save_raw` and
+    :func:`pyclassic.map.create_raw`.
+
+    :param filename: File name
+    :param writable: Open the map in read/write mode
+
+    :type filename: str
+    :type writable: bool, optional
+
+    :raise pyclassic.map.ClassicMapError: Not a raw map or the file is
+                                          truncated.
+    :return: The offset and the map object.
+    :rtype:  (int, int, int), :class:`pyclassic.map.ClassicMap`
+    """
+    with open(filename, "r+b" if writable else "rb") as f:
+        offset, (width, height, length) = read_raw_header(f)
+        size = width*height*length
+        f.seek(0, 2)
+        if f.tell() < _raw_header_size + size:
+            raise ClassicMapError("Truncated raw map.")
+        mm = mmap.mmap(f.fileno(), _raw_header_size + size,
+                       access = mmap.ACCESS_WRITE if writable
+                                else mmap.ACCESS_COPY)
+
+    blocks = memoryview(mm)[_raw_header_size:]
+    m = ClassicMap.from_blocks(blocks, width, height, length)
+    m.mmap = mm
+    return offset, m
+
+def create_raw(filename, width, height, length, ox = 0, oy = 0, oz = 0):
+    """
+    Creates a raw map filled with air without writing every block,
+    then opens it in read/write mode. See
+    :func:`pyclassic.map.open_raw`.
+
+    :type filename: str
+    :type width:  int
+    :type height: int
+    :type length: int
+    :type ox: int, optional
+    :type oy: int, optional
+    :type oz: int, optional
+
+    :return: The offset and the map object.
+    :rtype:  (int, int, int), :class:`pyclassic.map.ClassicMap`
+    """
+    with open(filename, "wb") as f:
+        f.write(raw_header(width, height, length, ox, oy, oz))
+        f.truncate(_raw_header_size + width*height*length)
+    return open_raw(filename, True)
+
+def raw_header(width, height, length, ox = 0, oy = 0, oz = 0):
+    """
+    Makes the header of a raw map. Used internally.
+
+    :rtype: bytes
+    """
+    header = _raw_magic + encint(ox) + encint(oy) + encint(oz) + \
+        encint(width) + encint(height) + encint(length)
+    return header.ljust(_raw_header_size, b'\0')
+
+class LevelAssembler:
+    """
+    Assembles the level sent by the server as it is being downloaded.
+    Every chunk is decompressed as soon as it is received. Once the
+    4 bytes length prefix is known, a buffer of the exact size of the
+    level is allocated and the data is decompressed straight into it,
+    so the whole level is never held more than once in memory.
+
+    Example::
+
+        level = LevelAssembler()
+        level.feed(chunk)  # for each LEVEL_DATA_CHUNK
+        themap = level.finalize(width, height, length)
+    """
+    #: Maximum size of the data decompressed at once
+    step = 1 << 16
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Drops everything received so far and gets ready for a new
+        level.
+        """
+        self.decompressor = zlib.decompressobj(wbits = 31)
+        #: Level data (with the length prefix), its size is exact once
+        #: the prefix has been received.
+        self.data = bytearray()
+        #: Amount of bytes decompressed so far
+        self.size = 0
+
+    def write(self, out):
+        """
+        Writes decompressed data in the buffer. Used internally.
+        """
+        if not out: return
+        data, pos = self.data, self.size
+        if pos < 4 <= pos + len(out):
+            # The prefix is complete: allocate the whole level at once
+            data += out
+            total = 4 + int.from_bytes(data[:4], "big")
+            if total > len(data):
+                self.data = bytearray(total)
+                self.data[:len(data)] = data
+        else:
+            data[pos:pos+len(out)] = out
+        self.size = pos + len(out)
+
+    def feed(self, chunk):
+        """
+        Decompresses a chunk of level data into the level buffer.
+
+        :param chunk: Compressed chunk (without the padding)
+        :type chunk:  bytes
+        """
+        d = self.decompressor
+        self.write(d.decompress(chunk, self.step))
+        while d.unconsumed_tail:
+            self.write(d.decompress(d.unconsumed_tail, self.step))
+
+    def finish(self):
+        """
+        Flushes the decompressor and returns the level data, then
+        resets the assembler.
+
+        :return: Level data with the 4 bytes length prefix
+        :rtype:  bytearray
+        """
+        self.write(self.decompressor.flush())
+        data = self.data
+        del data[self.size:]
+        self.reset()
+        return data
+
+    def finalize(self, width, height, length):
+        """
+        Builds the map from everything that has been received then
+        resets the assembler. The map uses the level buffer without
+        copying it.
+
+        :return: The downloaded map
+        :rtype:  :class:`pyclassic.map.ClassicMap`
+        """
+        data = self.finish()
+        level = ClassicMap.from_blocks(memoryview(data)[4:],
+                                       width, height, length)
+        level.data = data
+        return level
+
+class ChangeTracker:
+    """
+    Keeps track of the changes made to a map, see
+    :func:`pyclassic.map.ClassicMap.track_changes`.
+
+    Every change increments a version number. The map is divided in
+    cubic chunks and the tracker stores the version of the last change
+    of every chunk, along with a bounded log of the last single block
+    changes.
+
+    :param classic_map: The tracked map
+    :param chunk_size:  Size of the chunks
+    :param log_size:    Maximum amount of changes kept in the log
+
+    :type classic_map: :class:`pyclassic.map.ClassicMap`
+    :type chunk_size:  int, optional
+    :type log_size:    int, optional
+    """
+    def __init__(self, classic_map, chunk_size = 16, log_size = 65536):
+        cs = self.chunk_size = chunk_size
+        self.nx = -(-classic_map.width // cs)
+        self.ny = -(-classic_map.height // cs)
+        self.nz = -(-classic_map.length // cs)
+        #: Version of the last change.
+        self.version = 0
+        self.chunks = array('Q', [0]) * (self.nx*self.ny*self.nz)
+        self.log = deque(maxlen = log_size)
+        # The log only holds the changes made after this version.
+        self.log_start = 0
+
+    def chunk_index(self, x, y, z):
+        """
+        :return: Index of the chunk containing a position
+        :rtype:  int
+        """
+        cs = self.chunk_size
+        return ((y//cs)*self.nz + z//cs)*self.nx + x//cs
+
+    def mark(self, x, y, z, bid):
+        """
+        Records a single block change.
+        """
+        self.version += 1
+        self.chunks[self.chunk_index(x, y, z)] = self.version
+        if len(self.log) == self.log.maxlen:
+            self.log_start = self.log[0][0]
+        self.log.append((self.version, x, y, z, bid))
+
+    def mark_box(self, box):
+        """
+        Records a bulk change of a whole region. It is not added to
+        the log, which can then only describe the changes made after.
+
+        :param box: Minimum and maximum corners of the region
+        """
+        (ax, ay, az), (bx, by, bz) = box
+        self.version += 1
+        cs = self.chunk_size
+        for cy in range(ay//cs, by//cs + 1):
+            for cz in range(az//cs, bz//cs + 1):
+                i = (cy*self.nz + cz)*self.nx
+                for cx in range(ax//cs, bx//cs + 1):
+                    self.chunks[i + cx] = self.version
+        self.log_start = self.version
+
+    def mark_chunks(self, chunks):
+        """
+        Records a bulk change of some chunks, see
+        :func:`pyclassic.map.ChangeTracker.mark_box`.
+
+        :param chunks: Chunk indexes
+        :type chunks:  iterable[int]
+        """
+        self.version += 1
+        for i in chunks:
+            self.chunks[i] = self.version
+        self.log_start = self.version
+
+    def mark_indexes(self, idxs, width, length):
+        """
+        Records a bulk change of some blocks, see
+        :func:`pyclassic.map.ChangeTracker.mark_box`.
+
+        :param idxs: Block buffer indexes of the changed blocks
+        :type idxs:  list[int] or numpy.ndarray
+        """
+        cs, nx, nz = self.chunk_size, self.nx, self.nz
+        if numpy is not None:
+            idxs = numpy.asarray(idxs, dtype = numpy.int64)
+            self.mark_chunks(numpy.unique(
+                ((idxs // width // length // cs)*nz +
+                 (idxs // width % length) // cs)*nx +
+                (idxs % width) // cs).tolist())
+        else:
+            self.mark_chunks({((i // width // length // cs)*nz +
+                               (i // width % length) // cs)*nx +
+                              (i % width) // cs for i in idxs})
+
+    def changes_since(self, version):
+        """
+        :param version: Version to compare with
+        :type version:  int
+
+        :return: Single block changes made after a version as
+                 (x, y, z, block ID), or None if the log does not go
+                 back this far (or there has been bulk changes since).
+        :rtype:  list[(int, int, int, int)] or None
+        """
+        if version < self.log_start: return None
+        changes = []
+        for entry in reversed(self.log):
+            if entry[0] <= version: break
+            changes.append(entry[1:])
+        changes.reverse()
+        return changes
+
+    def dirty_chunks(self, since = 0):
+        """
+        :param since: Version to compare with
+        :type since:  int, optional
+
+        :return: Chunks changed after a version, as chunk coordinates
+        :rtype:  list[(int, int, int)]
+        """
+        nx, nz = self.nx, self.nz
+        return [(i % nx, i // nx // nz, i // nx % nz)
+                for i, v in enumerate(self.chunks) if v > since]
+
+class BlockIndex:
+    """
+    Index of the positions of some block IDs in a map, see
+    :func:`pyclassic.map.ClassicMap.index_blocks`.
+
+    Positions are stored as block buffer indexes, in one set per chunk
+    (cubic chunks of `chunk_size` blocks) so that queries on a region
+    or around a position only look at the chunks nearby.
+
+    :param classic_map: The indexed map
+    :param bids:        Block IDs to index
+    :param chunk_size:  Size of the chunks
+
+    :type classic_map: :class:`pyclassic.map.ClassicMap`
+    :type bids:        iterable[int]
+    :type chunk_size:  int, optional
+    """
+    def __init__(self, classic_map, bids, chunk_size = 16):
+        self.map = classic_map
+        cs = self.chunk_size = chunk_size
+        self.nx = -(-classic_map.width // cs)
+        self.ny = -(-classic_map.height // cs)
+        self.nz = -(-classic_map.length // cs)
+        #: {block ID: {chunk index: set of block buffer indexes}}
+        self.positions = {bid: {} for bid in bids}
+        #: Amount of blocks of each indexed block ID
+        self.counts = dict.fromkeys(self.positions, 0)
+        self.refresh()
+
+    def chunk_of(self, idx):
+        """
+        :return: Index of the chunk containing a block buffer index
+        :rtype:  int
+        """
+        w, l, cs = self.map.width, self.map.length, self.chunk_size
+        return (((idx // w // l) // cs)*self.nz + (idx // w % l) // cs) \
+            * self.nx + (idx % w) // cs
+
+    def add(self, idx, bid):
+        """
+        Records a block, does nothing if its ID is not indexed.
+
+        :param idx: Block buffer index
+        :param bid: Block ID
+        """
+        chunks = self.positions.get(bid)
+        if chunks is None: return
+        chunks.setdefault(self.chunk_of(idx), set()).add(idx)
+        self.counts[bid] += 1
+
+    def remove(self, idx, bid):
+        """
+        Forgets a block, does nothing if its ID is not indexed.
+
+        :param idx: Block buffer index
+        :param bid: Block ID
+        """
+        chunks = self.positions.get(bid)
+        if chunks is None: return
+        c = self.chunk_of(idx)
+        chunk = chunks[c]
+        chunk.remove(idx)
+        if not chunk: del chunks[c]
+        self.counts[bid] -= 1
+
+    def refresh(self, box = None):
+        """
+        Rebuilds the index for the chunks touched by a region, after
+        a bulk change of the map.
+
+        :param box: Minimum and maximum corners of the region, the
+                    whole map if None
+        """
+        m, cs = self.map, self.chunk_size
+        if box is None:
+            box = ((0, 0, 0), (m.width-1, m.height-1, m.length-1))
+        (ax, ay, az), (bx, by, bz) = box
+        # Rebuild whole chunks
+        ax, ay, az = ax//cs*cs, ay//cs*cs, az//cs*cs
+        bx, by, bz = min((bx//cs+1)*cs, m.width) - 1, \
+            min((by//cs+1)*cs, m.height) - 1, \
+            min((bz//cs+1)*cs, m.length) - 1
+
+        chunks = [(cy*self.nz + cz)*self.nx + cx
+                  for cy in range(ay//cs, by//cs + 1)
+                  for cz in range(az//cs, bz//cs + 1)
+                  for cx in range(ax//cs, bx//cs + 1)]
+        for bid, positions in self.positions.items():
+            for c in chunks:
+                old = positions.pop(c, None)
+                if old: self.counts[bid] -= len(old)
+            for idx in m.indexes_of(bid, ((ax, ay, az), (bx, by, bz))):
+                positions.setdefault(self.chunk_of(idx), set()).add(idx)
+                self.counts[bid] += 1
+
+    def replace(self, from_bid, to_bid):
+        """
+        Updates the index after every block of a given ID has been
+        replaced by another one.
+        """
+        positions = self.positions
+        if to_bid in positions and from_bid not in positions:
+            # The new positions are unknown
+            return self.refresh()
+        old = positions.get(from_bid)
+        if old is None: return
+        positions[from_bid] = {}
+        if to_bid in positions:
+            for c, chunk in old.items():
+                positions[to_bid].setdefault(c, set()).update(chunk)
+            self.counts[to_bid] += self.counts[from_bid]
+        self.counts[from_bid] = 0
+
+    def chunk_lists(self, bid, box):
+        """
+        Lists the sets of positions of the chunks touched by a region.
+        Used internally.
+        """
+        positions = self.positions[bid]
+        (ax, ay, az), (bx, by, bz) = box
+        cs = self.chunk_size
+        n = (by//cs - ay//cs + 1) * (bz//cs - az//cs + 1) * \
+            (bx//cs - ax//cs + 1)
+        if n > len(positions):
+            return positions.values()
+        return [positions[c] for c in
+                ((cy*self.nz + cz)*self.nx + cx
+                 for cy in range(ay//cs, by//cs + 1)
+                 for cz in range(az//cs, bz//cs + 1)
+                 for cx in range(ax//cs, bx//cs + 1))
+                if c in positions]
+
+    def in_region(self, bid, box):
+        """
+        See :func:`pyclassic.map.ClassicMap.in_region`
+        """
+        (ax, ay, az), (bx, by, bz) = box
+        getpos = self.map.getpos
+        return sorted(pos for chunk in self.chunk_lists(bid, box)
+                      for pos in map(getpos, chunk)
+                      if ax <= pos[0] <= bx and ay <= pos[1] <= by
+                      and az <= pos[2] <= bz)
+
+    def nearest(self, bid, pos, max_distance = None):
+        """
+        See :func:`pyclassic.map.ClassicMap.nearest`
+        """
+        x, y, z = pos
+        cs, nx, nz = self.chunk_size, self.nx, self.nz
+        getpos = self.map.getpos
+
+        def bound(c):
+            # Distance between the position and the chunk box
+            cx, cy, cz = c % nx * cs, c // nx // nz * cs, c // nx % nz * cs
+            return sum(max(a - v, 0, v - a - cs + 1)**2 for v, a in
+                       ((x, cx), (y, cy), (z, cz)))
+
+        best, best_d = None, float("inf") if max_distance is None \
+            else max_distance**2
+        for d, c in sorted((bound(c), c) for c in self.positions[bid]):
+            if d > best_d: break
+            for p in map(getpos, self.positions[bid][c]):
+                pd = (p[0]-x)**2 + (p[1]-y)**2 + (p[2]-z)**2
+                if pd < best_d or (pd == best_d and
+                                   (best is None or p < best)):
+                    best, best_d = p, pd
+        return best
 
 class ClassicMap:
     """
@@ -54,6 +654,7 @@ class ClassicMap:
 
     :param data: Raw data downloaded from the server, compressed or not
     :param compressed: If true, it will decompress the data using gzip
+                       (see :class:`pyclassic.map.LevelAssembler`)
 
     :type data:   bytes
     :type width:  int
@@ -64,14 +665,330 @@ class ClassicMap:
     # NOTE: Maybe we could add offset in the class.
     def __init__(self, data: bytes, width, height, length,
                  compressed = True):
-        self.data = bytearray(
-            gzip.decompress(data) if compressed else data)
-        magic = decint(self.data[:2])
+        if compressed:
+            level = LevelAssembler()
+            level.feed(data)
+            self.data = level.finish()
+        else:
+            self.data = bytearray(data)
 
-        self.blocks = self.data[4:]
+        #: The blocks, a view of :attr:`data` without the length prefix.
+        self.blocks = memoryview(self.data)[4:]
         self.width = width
         self.height = height
         self.length = length
+        #: mmap object if the map is a raw map opened with
+        #: :func:`pyclassic.map.open_raw`.
+        self.mmap = None
+        #: Change tracker, see :func:`track_changes`
+        self.tracker = None
+        #: Block index, see :func:`index_blocks`
+        self.block_index = None
+
+    @classmethod
+    def from_blocks(cls, blocks, width, height, length):
+        """
+        Makes a map straight from the block buffer (without the 4
+        bytes length prefix), without copying it.
+
+        :param blocks: Writable buffer of blocks, such as a bytearray
+        :type blocks:  bytearray or memoryview
+
+        :return: The map using this buffer
+        :rtype:  :class:`pyclassic.map.ClassicMap`
+        """
+        m = cls.__new__(cls)
+        m.data = None
+        m.blocks = blocks
+        m.width = width
+        m.height = height
+        m.length = length
+        m.mmap = None
+        m.tracker = None
+        m.block_index = None
+        return m
+
+    def track_changes(self, chunk_size = 16, log_size = 65536):
+        """
+        Enables change tracking, so that snapshots, backups and other
+        consumers can only process what changed since a given version.
+        Changes made through the map methods are tracked, but not the
+        ones made directly on :attr:`blocks` or :attr:`array`.
+
+        Example::
+
+            m.track_changes()
+            version = m.version
+            # ... later
+            region_file.save(m, m.dirty_chunks(version))
+            version = m.version
+
+        :param chunk_size: Size of the chunks
+        :param log_size:   Maximum amount of single block changes kept
+
+        :type chunk_size: int, optional
+        :type log_size:   int, optional
+
+        :return: The tracker
+        :rtype:  :class:`pyclassic.map.ChangeTracker`
+        """
+        self.tracker = ChangeTracker(self, chunk_size, log_size)
+        return self.tracker
+
+    @property
+    def version(self):
+        """
+        Version of the last change, see :func:`track_changes`.
+
+        :raise pyclassic.map.ClassicMapError: Changes are not tracked.
+        :rtype: int
+        """
+        if not self.tracker:
+            raise ClassicMapError("Changes are not tracked.")
+        return self.tracker.version
+
+    def changes_since(self, version):
+        """
+        See :func:`pyclassic.map.ChangeTracker.changes_since`
+
+        :raise pyclassic.map.ClassicMapError: Changes are not tracked.
+        """
+        if not self.tracker:
+            raise ClassicMapError("Changes are not tracked.")
+        return self.tracker.changes_since(version)
+
+    def dirty_chunks(self, since = 0):
+        """
+        See :func:`pyclassic.map.ChangeTracker.dirty_chunks`
+
+        :raise pyclassic.map.ClassicMapError: Changes are not tracked.
+        """
+        if not self.tracker:
+            raise ClassicMapError("Changes are not tracked.")
+        return self.tracker.dirty_chunks(since)
+
+    def index_blocks(self, bids, chunk_size = 16):
+        """
+        Indexes the positions of some block IDs, so that
+        :func:`find`, :func:`count`, :func:`nearest` and
+        :func:`in_region` answer in time proportional to the results
+        instead of scanning the map. The index is kept up to date by
+        the map methods, but not by changes made directly on
+        :attr:`blocks` or :attr:`array`.
+
+        Example::
+
+            m.index_blocks([8, 9, 10, 11, 46])  # Water, lava and TNT
+            m.nearest(46, bot.position)
+
+        :param bids:       Block IDs to index
+        :param chunk_size: Size of the chunks of the index
+
+        :type bids:       iterable[int]
+        :type chunk_size: int, optional
+
+        :return: The index
+        :rtype:  :class:`pyclassic.map.BlockIndex`
+        """
+        self.block_index = BlockIndex(self, bids, chunk_size)
+        return self.block_index
+
+    def is_indexed(self, bid):
+        """
+        :return: True if the block ID is in the block index
+        :rtype:  bool
+        """
+        return bool(self.block_index) and bid in self.block_index.positions
+
+    def indexes_of(self, bid, box = None):
+        """
+        Scans the map (or a region of it) for a block ID.
+        Used internally.
+
+        :param box: Minimum and maximum corners of the region, the
+                    whole map if None
+        :return: Block buffer indexes
+        :rtype:  list[int]
+        """
+        if box is None:
+            if numpy is not None:
+                return numpy.flatnonzero(
+                    numpy.frombuffer(self.blocks, dtype = numpy.uint8)
+                    == bid).tolist()
+            box = ((0, 0, 0), (self.width-1, self.height-1, self.length-1))
+
+        (ax, ay, az), (bx, by, bz) = box
+        if numpy is not None:
+            ys, zs, xs = numpy.nonzero(
+                self.array[ay:by+1, az:bz+1, ax:bx+1] == bid)
+            return ((xs + ax) + (zs + az)*self.width +
+                    (ys + ay)*self.width*self.length).tolist()
+
+        result = []
+        b = bytes([bid])
+        for i, j in self.rows(box):
+            row = bytes(self.blocks[i:j])
+            p = row.find(b)
+            while p != -1:
+                result.append(i + p)
+                p = row.find(b, p + 1)
+        return result
+
+    def find(self, bid):
+        """
+        Finds every block of a given ID. Scans the map if the block ID
+        is not indexed, see :func:`index_blocks`.
+
+        :param bid: Block ID
+        :type bid:  int
+
+        :return: Positions of the blocks
+        :rtype:  list[(int, int, int)]
+        """
+        if self.is_indexed(bid):
+            return sorted(self.getpos(idx) for chunk in
+                          self.block_index.positions[bid].values()
+                          for idx in chunk)
+        return sorted(map(self.getpos, self.indexes_of(bid)))
+
+    def count(self, bid):
+        """
+        Counts the blocks of a given ID. Scans the map if the block ID
+        is not indexed, see :func:`index_blocks`.
+
+        :param bid: Block ID
+        :type bid:  int
+
+        :rtype: int
+        """
+        if self.is_indexed(bid):
+            return self.block_index.counts[bid]
+        return bytes(self.blocks).count(bytes([bid]))
+
+    def in_region(self, bid, box):
+        """
+        Finds the blocks of a given ID in a region. Scans the region
+        if the block ID is not indexed, see :func:`index_blocks`.
+
+        :param bid: Block ID
+        :param box: Two opposite corners of the region (both included)
+
+        :type bid: int
+        :type box: ((int, int, int), (int, int, int))
+
+        :return: Positions of the blocks
+        :rtype:  list[(int, int, int)]
+        """
+        box = self.clip_box(box)
+        if not box: return []
+        if self.is_indexed(bid):
+            return self.block_index.in_region(bid, box)
+        return sorted(map(self.getpos, self.indexes_of(bid, box)))
+
+    def nearest(self, bid, pos, max_distance = None):
+        """
+        Finds the nearest block of a given ID from a position. Scans
+        the map if the block ID is not indexed, see
+        :func:`index_blocks`.
+
+        :param bid: Block ID
+        :param pos: Position
+        :param max_distance: Ignore blocks farther than this
+
+        :type bid: int
+        :type pos: (float, float, float)
+        :type max_distance: float or None, optional
+
+        :return: Position of the nearest block or None
+        :rtype:  (int, int, int) or None
+        """
+        if self.is_indexed(bid):
+            return self.block_index.nearest(bid, pos, max_distance)
+        x, y, z = pos
+        best, best_d = None, float("inf") if max_distance is None \
+            else max_distance**2
+        for p in map(self.getpos, self.indexes_of(bid)):
+            pd = (p[0]-x)**2 + (p[1]-y)**2 + (p[2]-z)**2
+            if pd < best_d or (pd == best_d and
+                               (best is None or p < best)):
+                best, best_d = p, pd
+        return best
+
+    def sync(self):
+        """
+        Makes sure the changes made to a raw map opened with
+        :func:`pyclassic.map.open_raw` are written to the disk. Does
+        nothing on other maps.
+        """
+        if self.mmap and not self.mmap.closed:
+            self.mmap.flush()
+
+    def close(self):
+        """
+        Closes the file of a raw map. The map cannot be used anymore
+        afterwards. Does nothing on other maps.
+        """
+        if self.mmap:
+            self.sync()
+            self.blocks.release()
+            self.mmap.close()
+            self.mmap = None
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def array(self):
+        """
+        The blocks as a NumPy array of shape (height, length, width),
+        so indexed as `array[y, z, x]`. It is a view over the block
+        buffer: editing the array edits the map.
+
+        :raise pyclassic.map.ClassicMapError: NumPy is not installed.
+        :rtype: numpy.ndarray
+        """
+        if numpy is None:
+            raise ClassicMapError("NumPy is required for this.")
+        return numpy.frombuffer(self.blocks, dtype = numpy.uint8) \
+                    .reshape(self.height, self.length, self.width)
+
+    def clip_box(self, box):
+        """
+        Sorts the corners of a box and clips it to the map boundaries.
+
+        :param box: Two opposite corners (both included)
+        :type box:  ((int, int, int), (int, int, int))
+
+        :return: Minimum and maximum corners or None if the box is
+                 outside of the map.
+        :rtype:  ((int, int, int), (int, int, int)) or None
+        """
+        (x1, y1, z1), (x2, y2, z2) = box
+        ax, ay, az = max(min(x1, x2), 0), max(min(y1, y2), 0), \
+            max(min(z1, z2), 0)
+        bx, by, bz = min(max(x1, x2), self.width - 1), \
+            min(max(y1, y2), self.height - 1), \
+            min(max(z1, z2), self.length - 1)
+        if ax > bx or ay > by or az > bz:
+            return None
+        return (ax, ay, az), (bx, by, bz)
+
+    def rows(self, box):
+        """
+        Iterates over the rows (along X) of a box. Used internally for
+        row-wise operations.
+
+        :return: start and stop index of every row in the block buffer
+        :rtype:  iterator[(int, int)]
+        """
+        (ax, ay, az), (bx, by, bz) = box
+        w, wl = self.width, self.width*self.length
+        for y in range(ay, by+1):
+            for z in range(az, bz+1):
+                i = ax + z*w + y*wl
+                yield i, i + bx - ax + 1
         
     def __getitem__(self, vector):
         if type(vector) == slice:
@@ -92,24 +1009,33 @@ class ClassicMap:
         stop = vectors.stop
         if not stop: return None
 
-        v1 = [min(a,b) for a, b in zip(start, stop)]
-        v2 = [max(a,b) for a, b in zip(start, stop)]
-        
-        w, h, l = v2[0]-v1[0]+1, v2[1]-v1[1]+1, v2[2]-v1[2]+1
-        n = b'\0\0\0\0'
-        for y in range(v1[1], v2[1]+1):
-            y *= self.width*self.length
-            for z in range(v1[2], v2[2]+1):
-                z *= self.width
-                n += self.blocks[v1[0]+y+z:v2[0]+y+z+1]
+        # The region is clipped to the map boundaries.
+        box = self.clip_box((start, stop))
+        if not box: return None
+        (ax, ay, az), (bx, by, bz) = box
+        w, h, l = bx-ax+1, by-ay+1, bz-az+1
 
-        return ClassicMap(n, w, h, l, compressed = False)
+        if numpy is not None:
+            region = self.array[ay:by+1, az:bz+1, ax:bx+1]
+            return ClassicMap.from_blocks(bytearray(region.tobytes()),
+                                          w, h, l)
+
+        n = bytearray()
+        for i, j in self.rows(box):
+            n += self.blocks[i:j]
+        return ClassicMap.from_blocks(n, w, h, l)
 
     def __setitem__(self, vector, bid):
         if len(vector) != 3: raise ClassicMapError("not a vector")
         x, y, z = vector
 
         idx = x+(z*self.width)+(y*self.width*self.length)
+        old = self.blocks[idx]
+        if old != bid:
+            if self.tracker: self.tracker.mark(x, y, z, bid)
+            if self.block_index:
+                self.block_index.remove(idx, old)
+                self.block_index.add(idx, bid)
         self.blocks[idx] = bid
 
     def getpos(self, idx):
@@ -127,68 +1053,458 @@ class ClassicMap:
         z = (idx // self.width) % self.length
         return x, y, z
 
-    def save(self, filename, compresslevel = 9, ox=0,oy=0,oz=0):
+    def save(self, filename, compresslevel = 9, ox=0,oy=0,oz=0,
+             strategy = zlib.Z_DEFAULT_STRATEGY, workers = None):
         """
-        Saves the map in a file.
+        Saves the map in a file. The map is compressed on multiple
+        cores, see :func:`pyclassic.map.write_gzip`.
 
         :param filename:      Name of the file to save.
         :param compresslevel: Level of gzip compression.
         :param ox: X offset
         :param oy: Y offset
         :param oz: Z offset
+        :param strategy: zlib strategy
+        :param workers: Number of compression threads, the number of
+                        CPUs if None
 
         :type filename:      str
         :type compresslevel: int, optional
         :type ox: int, optional
         :type oy: int, optional
         :type oz: int, optional
+        :type strategy: int, optional
+        :type workers: int or None, optional
+        """
+        header = encint(ox) + encint(oy) + encint(oz) + \
+            encint(self.width) + encint(self.height) + \
+            encint(self.length) + b'\0\0\0\0'
+        with open(filename, "wb") as f:
+            write_gzip(f, self.blocks, compresslevel, strategy, workers,
+                       header = header)
+
+    def save_raw(self, filename, ox = 0, oy = 0, oz = 0):
+        """
+        Saves the map uncompressed in the raw format, see
+        :func:`pyclassic.map.open_raw`.
+
+        :param filename: Name of the file to save.
+        :param ox: X offset
+        :param oy: Y offset
+        :param oz: Z offset
+
+        :type filename: str
+        :type ox: int, optional
+        :type oy: int, optional
+        :type oz: int, optional
+        """
+        with open(filename, "wb") as f:
+            f.write(raw_header(self.width, self.height, self.length,
+                               ox, oy, oz))
+            f.write(self.blocks)
+
+    def iter_blocks(self, box = None, skip = None):
+        """
+        Iterates over the blocks of the map (or of a region of it) in
+        the order of the block buffer (Y, Z then X). Positions come
+        from nested ranges, nothing is computed per block.
+
+        :param box: Two opposite corners of the region (both included),
+                    the whole map if None
+        :param skip: Block IDs to leave out, such as `{0}` for air
+
+        :type box: ((int, int, int), (int, int, int)) or None, optional
+        :type skip: iterable[int] or None, optional
+
+        :return: (x, y, z, block ID) of every block
+        :rtype:  iterator[(int, int, int, int)]
+        """
+        if box is None:
+            box = ((0, 0, 0), (self.width-1, self.height-1, self.length-1))
+        box = self.clip_box(box)
+        if not box: return
+        (ax, ay, az), (bx, by, bz) = box
+        skip = bytes(set(skip)) if skip else b''
+        xs = range(ax, bx+1)
+        blocks = self.blocks
+        w, wl = self.width, self.width*self.length
+        for y in range(ay, by+1):
+            for z in range(az, bz+1):
+                i = ax + z*w + y*wl
+                row = bytes(blocks[i:i + len(xs)])
+                if not skip:
+                    for x, bid in zip(xs, row):
+                        yield x, y, z, bid
+                elif row.translate(None, skip):
+                    for x, bid in zip(xs, row):
+                        if bid not in skip:
+                            yield x, y, z, bid
+
+    def queue_from_arrays(self, xs, ys, zs, bids):
+        """
+        Makes a :class:`pyclassic.queue.BlockQueue` from NumPy arrays
+        without going through Python integers. Used internally.
         """
-        with gzip.open(filename, "wb") as f:
-            f.write(encint(ox) + encint(oy) + encint(oz))
-            f.write(encint(self.width) + encint(self.height) + \
-                    encint(self.length))
-            f.write(b'\0\0\0\0' + self.blocks)
+        q = queue.BlockQueue()
+        for column, values in ((q.x, xs), (q.y, ys), (q.z, zs)):
+            # Like array('h'), do not silently wrap around.
+            if len(values) and (values.min() < -32768 or
+                                values.max() > 32767):
+                raise OverflowError("Position out of the range of a "
+                                    "signed short.")
+            column.frombytes(memoryview(numpy.ascontiguousarray(
+                values, dtype = numpy.int16)).cast('B'))
+        q.bid.frombytes(memoryview(numpy.ascontiguousarray(
+            bids, dtype = numpy.uint8)).cast('B'))
+        return q
 
-    def get_queue(self, ox = 0, oy = 0, oz = 0):
+    def get_queue(self, ox = 0, oy = 0, oz = 0, skip = None):
         """
-        Turns a map into a queue, a list of
-        :class:`pyclassic.queue.Block` to be used with
+        Turns a map into a queue, a
+        :class:`pyclassic.queue.BlockQueue` to be used with
         :class:`pyclassic.queue.ThreadedQueue`
 
         :param ox: X offset
         :param oy: Y offset
         :param oz: Z offset
+        :param skip: Block IDs to leave out, such as `{0}` to not
+                     place air
 
         :type ox: int, optional
         :type oy: int, optional
         :type oz: int, optional
+        :type skip: iterable[int] or None, optional
 
         :return: The queue converted from the map.
-        :rtype:  list[:class:`pyclassic.queue.ThreadedQueue`]
+        :rtype:  :class:`pyclassic.queue.BlockQueue`
         """
-        return [queue.Block(
-            *[x+y for x, y in zip(self.getpos(idx),(ox,oy,oz))], bid)
-                for idx, bid in enumerate(self.blocks)]
+        w, h, l = self.width, self.height, self.length
+        if skip and numpy is not None:
+            a = self.array
+            ys, zs, xs = numpy.nonzero(~numpy.isin(a, list(skip)))
+            return self.queue_from_arrays(xs + ox, ys + oy, zs + oz,
+                                          a[ys, zs, xs])
+        if skip:
+            pqueue = queue.BlockQueue()
+            for x, y, z, bid in self.iter_blocks(skip = skip):
+                pqueue.add(x+ox, y+oy, z+oz, bid)
+            return pqueue
+
+        # The columns are made of repeated patterns
+        pqueue = queue.BlockQueue()
+        pqueue.x = array('h', range(ox, ox+w)) * (h*l)
+        for y in range(oy, oy+h):
+            pqueue.y.extend(array('h', [y]) * (w*l))
+        for z in range(oz, oz+l):
+            pqueue.z.extend(array('h', [z]) * w)
+        pqueue.z *= h
+        pqueue.bid = array('B', self.blocks)
+        return pqueue
 
     def get_queue_from_region(self, x1, y1, z1, x2, y2, z2,
                               ox = 0, oy = 0, oz = 0):
+        # The region is clipped to the map boundaries.
+        box = self.clip_box(((x1, y1, z1), (x2, y2, z2)))
+        if not box: return queue.BlockQueue()
+        (ax, ay, az), (bx, by, bz) = box
 
-        ax, ay, az = [min(a,b) for a, b in zip((x1,y1,z1), (x2,y2,z2))]
-        bx, by, bz = [max(a,b) for a, b in zip((x1,y1,z1), (x2,y2,z2))]
+        if numpy is not None:
+            # Transposed to (x, y, z) to keep the same order.
+            region = self.array[ay:by+1, az:bz+1, ax:bx+1] \
+                         .transpose(2, 0, 1)
+            xs, ys, zs = numpy.indices(region.shape)
+            return self.queue_from_arrays(xs.ravel() + ox + ax,
+                                          ys.ravel() + oy + ay,
+                                          zs.ravel() + oz + az,
+                                          region.ravel())
 
-        pqueue = []
+        pqueue = queue.BlockQueue()
         for x in range(ax, bx+1):
             for y in range(ay, by+1):
                 for z in range(az, bz+1):
-                    if x >= self.width or \
-                       y >= self.height or \
-                       z >= self.length:
-                        continue
-                    pqueue.append(queue.Block(ox+x, oy+y, oz+z,
-                                        self[x,y,z]))
+                    pqueue.add(ox+x, oy+y, oz+z, self[x,y,z])
 
         return pqueue
 
+    def record_changes(self, box, idxs, changes = False):
+        """
+        Records the blocks changed by a bulk operation in the change
+        tracker and the block index. Used internally.
+
+        :param box: Minimum and maximum corners of the changed region
+        :param idxs: Block buffer indexes of the changed blocks
+        :param changes: Return the changed blocks instead of the count
+
+        :type idxs: list[int] or numpy.ndarray
+
+        :return: Amount of changed blocks or the changed blocks
+        :rtype:  int or :class:`pyclassic.queue.BlockQueue`
+        """
+        count = len(idxs)
+        if count and self.tracker:
+            self.tracker.mark_indexes(idxs, self.width, self.length)
+        if count and self.block_index:
+            self.block_index.refresh(box)
+        if not changes:
+            return count
+
+        w, l = self.width, self.length
+        if numpy is not None:
+            idxs = numpy.asarray(idxs, dtype = numpy.int64)
+            bids = numpy.frombuffer(self.blocks, dtype = numpy.uint8)[idxs]
+            return self.queue_from_arrays(idxs % w, idxs // w // l,
+                                          idxs // w % l, bids)
+        return queue.BlockQueue.from_arrays(
+            [i % w for i in idxs], [i // w // l for i in idxs],
+            [i // w % l for i in idxs], [self.blocks[i] for i in idxs])
+
+    def region_indexes(self, box, selector):
+        """
+        Converts a boolean NumPy array over a region into block buffer
+        indexes. Used internally.
+        """
+        (ax, ay, az), _ = box
+        ys, zs, xs = numpy.nonzero(selector)
+        return (xs + ax) + (zs + az)*self.width + \
+            (ys + ay)*self.width*self.length
+
+    def fill(self, box, bid, changes = False):
+        """
+        Fills a region with a block.
+
+        :param box: Two opposite corners of the region (both included)
+        :param bid: Block ID
+        :param changes: Return the changed blocks instead of the count
+
+        :type box: ((int, int, int), (int, int, int))
+        :type bid: int
+        :type changes: bool, optional
+
+        :return: Amount of changed blocks or the changed blocks
+        :rtype:  int or :class:`pyclassic.queue.BlockQueue`
+        """
+        box = self.clip_box(box)
+        if not box:
+            return queue.BlockQueue() if changes else 0
+        (ax, ay, az), (bx, by, bz) = box
+        if numpy is not None:
+            region = self.array[ay:by+1, az:bz+1, ax:bx+1]
+            idxs = self.region_indexes(box, region != bid)
+            region[...] = bid
+            return self.record_changes(box, idxs, changes)
+
+        row = bytes([bid]) * (bx-ax+1)
+        idxs = []
+        for i, j in self.rows(box):
+            old = bytes(self.blocks[i:j])
+            if old != row:
+                idxs.extend(i + k for k, b in enumerate(old) if b != bid)
+                self.blocks[i:j] = row
+        return self.record_changes(box, idxs, changes)
+
+    def replace(self, box, from_bid, to_bid, changes = False):
+        """
+        Replaces every block of a given ID by another one in a region.
+
+        :param box: Two opposite corners of the region (both included)
+        :param from_bid: Block ID to replace
+        :param to_bid:   New block ID
+        :param changes: Return the changed blocks instead of the count
+
+        :type box: ((int, int, int), (int, int, int))
+        :type from_bid: int
+        :type to_bid:   int
+        :type changes: bool, optional
+
+        :return: Amount of changed blocks or the changed blocks
+        :rtype:  int or :class:`pyclassic.queue.BlockQueue`
+        """
+        box = self.clip_box(box)
+        if not box or from_bid == to_bid:
+            return queue.BlockQueue() if changes else 0
+        (ax, ay, az), (bx, by, bz) = box
+        if numpy is not None:
+            region = self.array[ay:by+1, az:bz+1, ax:bx+1]
+            selector = region == from_bid
+            region[selector] = to_bid
+            return self.record_changes(
+                box, self.region_indexes(box, selector), changes)
+
+        b = bytes([from_bid])
+        table = bytearray(range(256))
+        table[from_bid] = to_bid
+        idxs = []
+        for i, j in self.rows(box):
+            row = bytes(self.blocks[i:j])
+            k = row.find(b)
+            if k == -1: continue
+            while k != -1:
+                idxs.append(i + k)
+                k = row.find(b, k + 1)
+            self.blocks[i:j] = row.translate(table)
+        return self.record_changes(box, idxs, changes)
+
+    def paste(self, other, offset = (0, 0, 0), mask = None,
+              changes = False):
+        """
+        Pastes another map (such as a region returned by
+        :func:`slice_down`) into this one. The parts that do not fit
+        in the map are ignored.
+
+        :param other: Map to paste
+        :param offset: Position of the corner of the pasted map
+        :param mask: Block ID of the other map that is not pasted
+                     (usually 0 to keep the blocks behind air)
+        :param changes: Return the changed blocks instead of the count
+
+        :type other: :class:`pyclassic.map.ClassicMap`
+        :type offset: (int, int, int), optional
+        :type mask: int or None, optional
+        :type changes: bool, optional
+
+        :return: Amount of changed blocks or the changed blocks
+        :rtype:  int or :class:`pyclassic.queue.BlockQueue`
+        """
+        ox, oy, oz = offset
+        box = self.clip_box(((ox, oy, oz),
+                             (ox + other.width - 1, oy + other.height - 1,
+                              oz + other.length - 1)))
+        if not box or not (other.width and other.height and other.length):
+            return queue.BlockQueue() if changes else 0
+        (ax, ay, az), (bx, by, bz) = box
+        if numpy is not None:
+            region = self.array[ay:by+1, az:bz+1, ax:bx+1]
+            source = other.array[ay-oy:by-oy+1, az-oz:bz-oz+1,
+                                 ax-ox:bx-ox+1]
+            selector = region != source
+            if mask is not None:
+                selector &= source != mask
+            region[selector] = source[selector]
+            return self.record_changes(
+                box, self.region_indexes(box, selector), changes)
+
+        idxs = []
+        n = bx - ax + 1
+        for i, j in self.rows(box):
+            y, z = i // self.width // self.length, \
+                i // self.width % self.length
+            k = (ax-ox) + (z-oz)*other.width + \
+                (y-oy)*other.width*other.length
+            old, new = bytes(self.blocks[i:j]), bytes(other.blocks[k:k+n])
+            if old == new: continue
+            if mask is not None:
+                new = bytes(o if b == mask else b for o, b in zip(old, new))
+            idxs.extend(i + x for x in range(n) if old[x] != new[x])
+            self.blocks[i:j] = new
+        return self.record_changes(box, idxs, changes)
+
+    def histogram(self):
+        """
+        Counts every block of the map.
+
+        :return: Amount of each block ID present in the map
+        :rtype:  dict[int, int]
+        """
+        if numpy is not None:
+            counts = numpy.bincount(
+                numpy.frombuffer(self.blocks, dtype = numpy.uint8),
+                minlength = 256)
+            return {bid: int(counts[bid])
+                    for bid in numpy.flatnonzero(counts).tolist()}
+        return dict(Counter(self.blocks))
+
+    def replace_all(self, from_bid, to_bid):
+        """
+        Replaces every block of a given ID by another one in the whole
+        map.
+
+        :param from_bid: Block ID to replace
+        :param to_bid:   New block ID
+
+        :type from_bid: int
+        :type to_bid:   int
+
+        :return: Amount of replaced blocks
+        :rtype:  int
+        """
+        if numpy is not None:
+            a = numpy.frombuffer(self.blocks, dtype = numpy.uint8)
+            mask = a == from_bid
+            a[mask] = to_bid
+            count = int(numpy.count_nonzero(mask))
+            if count and self.tracker and from_bid != to_bid:
+                self.tracker.mark_indexes(numpy.flatnonzero(mask),
+                                          self.width, self.length)
+        else:
+            blocks = bytes(self.blocks)
+            count = blocks.count(bytes([from_bid]))
+            if count and self.tracker and from_bid != to_bid:
+                idxs, find = [], blocks.find
+                i = find(from_bid)
+                while i != -1:
+                    idxs.append(i)
+                    i = find(from_bid, i + 1)
+                self.tracker.mark_indexes(idxs, self.width, self.length)
+            if count:
+                table = bytearray(range(256))
+                table[from_bid] = to_bid
+                self.blocks[:] = blocks.translate(table)
+
+        if count and self.block_index and from_bid != to_bid:
+            self.block_index.replace(from_bid, to_bid)
+        return count
+
+    def diff(self, other, offset = (0, 0, 0)):
+        """
+        Compares this map with another one placed at a given offset
+        and returns the blocks that differ. The result is the queue to
+        build to make this map look like `other`, which is useful to
+        rebuild or repair a structure. Only the part of `other` that
+        fits in this map is compared.
+
+        Rows are compared in bulk so the cost mostly depends on the
+        amount of changes.
+
+        :param other:  Target map
+        :param offset: Position of the target map in this map
+
+        :type other:  :class:`pyclassic.map.ClassicMap`
+        :type offset: (int, int, int), optional
+
+        :return: Blocks of `other` that differ, with the coordinates of
+                 this map.
+        :rtype:  :class:`pyclassic.queue.BlockQueue`
+        """
+        ox, oy, oz = offset
+        box = self.clip_box(((ox, oy, oz),
+                             (ox + other.width - 1,
+                              oy + other.height - 1,
+                              oz + other.length - 1)))
+        if not box: return queue.BlockQueue()
+        (ax, ay, az), (bx, by, bz) = box
+
+        if numpy is not None:
+            mine = self.array[ay:by+1, az:bz+1, ax:bx+1]
+            theirs = other.array[ay-oy:by-oy+1, az-oz:bz-oz+1,
+                                 ax-ox:bx-ox+1]
+            ys, zs, xs = numpy.nonzero(mine != theirs)
+            return queue.BlockQueue.from_arrays(
+                (xs + ax).tolist(), (ys + ay).tolist(),
+                (zs + az).tolist(), theirs[ys, zs, xs].tolist())
+
+        result = queue.BlockQueue()
+        mine, theirs = memoryview(self.blocks), memoryview(other.blocks)
+        size = bx - ax + 1
+        for y in range(ay, by+1):
+            for z in range(az, bz+1):
+                i = ax + z*self.width + y*self.width*self.length
+                j = (ax-ox) + (z-oz)*other.width + \
+                    (y-oy)*other.width*other.length
+                a, b = mine[i:i+size], theirs[j:j+size]
+                if a == b: continue
+                for x, (u, v) in enumerate(zip(a, b), ax):
+                    if u != v: result.add(x, y, z, v)
+        return result
 
     def copy(self):
         """
@@ -197,7 +1513,5 @@ class ClassicMap:
         :return: A copy of this map.
         :rtype: :class:`pyclassic.map.ClassicMap`
         """
-
-        data = b'\0\0\0\0' + self.blocks.copy()
         w, h, l = self.width, self.height, self.length
-        return ClassicMap(data, w, h, l, False)
+        return ClassicMap.from_blocks(bytearray(self.blocks), w, h, l)
@@ -0,0 +1,394 @@
+"""
+This module keeps track of the players (entities) of a server. It is
+used by :class:`pyclassic.PyClassic` to store the players seen by the
+event system.
+
+Players are stored in fixed arrays of 256 slots indexed by entity ID
+(the ID -1 of the bot itself is the slot 255), so updating a player
+is just a few array writes. Positions are kept in the protocol units
+(1/32 of a block).
+
+A grid of cubic cells is also maintained to find the players around
+a position without looking at every player.
+
+Movement tracking can be enabled with :func:`PlayerTable.track_movement`:
+the players that moved are then remembered until
+:func:`PlayerTable.flush` is called, once per tick, which also
+estimates their velocity.
+
+Example::
+
+    for pid in bot.players.within(x, y, z, 10):
+        print(bot.players.name(pid))
+
+    bot.players.track_movement()
+    # ... once per tick
+    for pid in bot.players.flush():
+        print(pid, bot.players.velocity(pid))
+"""
+import time
+from array import array
+from dataclasses import dataclass
+
+@dataclass
+class Player:
+    """
+    This is a simple class to store player data such as their position,
+    their username and their head direction.
+
+    .. note::
+        The players given by :class:`PlayerTable` are copies, changing
+        them does not change the table. Use the methods of the table
+        such as :func:`PlayerTable.teleport` instead.
+    """
+    __slots__ = ('name', 'x', 'y', 'z', 'pitch', 'yaw')
+
+    name: str
+    x: int
+    y: int
+    z: int
+    pitch: int
+    yaw: int
+
+class PlayerTable:
+    """
+    Player registry. It can be used like a dict of
+    :class:`pyclassic.players.Player` indexed by entity ID, the player
+    objects are made when they are read (so they are copies).
+
+    :param cell_size: Size of the cells of the grid index, in blocks
+    :type cell_size:  int, optional
+    """
+    def __init__(self, cell_size = 16):
+        self.cell = cell_size * 32
+        self.active = bytearray(256)
+        self.names = [None] * 256
+        self.x = array('i', [0]) * 256
+        self.y = array('i', [0]) * 256
+        self.z = array('i', [0]) * 256
+        self.yaw = bytearray(256)
+        self.pitch = bytearray(256)
+        # Grid index: {cell: set of slots} and the cell of every slot.
+        self.grid = {}
+        self.cells = [None] * 256
+        self.count = 0
+        # Movement tracking: slots that moved since the last flush,
+        # None if disabled.
+        self.changed = None
+        self.smoothing = 0.5
+        self.tick_x = array('i', [0]) * 256
+        self.tick_y = array('i', [0]) * 256
+        self.tick_z = array('i', [0]) * 256
+        self.tick_time = array('d', [0]) * 256
+        self.vx = array('d', [0]) * 256
+        self.vy = array('d', [0]) * 256
+        self.vz = array('d', [0]) * 256
+
+    def reindex(self, slot):
+        """
+        Moves a player to its new grid cell if it changed. Used
+        internally.
+        """
+        c = self.cell
+        gx, gy, gz = self.x[slot]//c, self.y[slot]//c, self.z[slot]//c
+        old = self.cells[slot]
+        if old is not None and old[0] == gx and old[1] == gy and \
+           old[2] == gz:
+            return
+        if old is not None:
+            cell = self.grid[old]
+            cell.discard(slot)
+            if not cell: del self.grid[old]
+        key = self.cells[slot] = (gx, gy, gz)
+        self.grid.setdefault(key, set()).add(slot)
+
+    ##################################################################
+    def spawn(self, pid, name, x, y, z, yaw = 0, pitch = 0):
+        """
+        Adds a player, or replaces the one with the same ID.
+
+        :param pid:  Entity ID
+        :param name: Player name
+        :param x:    X position, in 1/32 of a block
+        :param y:    Y position, in 1/32 of a block
+        :param z:    Z position, in 1/32 of a block
+
+        :type pid:  int
+        :type name: str or None
+        :type x:    int
+        :type y:    int
+        :type z:    int
+        :type yaw:   int, optional
+        :type pitch: int, optional
+        """
+        slot = pid & 0xff
+        if not self.active[slot]:
+            self.active[slot] = 1
+            self.count += 1
+        self.names[slot] = name
+        self.x[slot], self.y[slot], self.z[slot] = x, y, z
+        self.yaw[slot], self.pitch[slot] = yaw & 0xff, pitch & 0xff
+        self.reindex(slot)
+        if self.changed is not None:
+            self.tick_time[slot] = 0
+            self.vx[slot] = self.vy[slot] = self.vz[slot] = 0
+            self.changed.add(slot)
+
+    def despawn(self, pid):
+        """
+        Removes a player if it exists.
+
+        :param pid: Entity ID
+        :type pid:  int
+        """
+        slot = pid & 0xff
+        if not self.active[slot]: return
+        self.active[slot] = 0
+        self.count -= 1
+        self.names[slot] = None
+        cell = self.grid[self.cells[slot]]
+        cell.discard(slot)
+        if not cell: del self.grid[self.cells[slot]]
+        self.cells[slot] = None
+        if self.changed is not None:
+            self.changed.discard(slot)
+
+    def teleport(self, pid, x, y, z, yaw = None, pitch = None):
+        """
+        Moves a player to a position (in 1/32 of a block). Unknown
+        players are added without a name.
+        """
+        slot = pid & 0xff
+        if not self.active[slot]:
+            return self.spawn(pid, None, x, y, z, yaw or 0, pitch or 0)
+        self.x[slot], self.y[slot], self.z[slot] = x, y, z
+        if yaw is not None:
+            self.yaw[slot], self.pitch[slot] = yaw & 0xff, pitch & 0xff
+        self.reindex(slot)
+        if self.changed is not None: self.changed.add(slot)
+
+    def move(self, pid, dx, dy, dz):
+        """
+        Moves a player relatively (in 1/32 of a block). Does nothing
+        if the player is unknown.
+        """
+        slot = pid & 0xff
+        if not self.active[slot]: return
+        self.x[slot] += dx
+        self.y[slot] += dy
+        self.z[slot] += dz
+        self.reindex(slot)
+        if self.changed is not None: self.changed.add(slot)
+
+    def turn(self, pid, yaw, pitch):
+        """
+        Changes the head direction of a player. Does nothing if the
+        player is unknown.
+        """
+        slot = pid & 0xff
+        if not self.active[slot]: return
+        self.yaw[slot], self.pitch[slot] = yaw & 0xff, pitch & 0xff
+        if self.changed is not None: self.changed.add(slot)
+
+    def rename(self, pid, name):
+        """
+        Changes the name of a player. Does nothing if the player is
+        unknown.
+        """
+        slot = pid & 0xff
+        if self.active[slot]: self.names[slot] = name
+
+    def clear(self):
+        """
+        Removes every player.
+        """
+        changed, smoothing = self.changed, self.smoothing
+        self.__init__(self.cell // 32)
+        if changed is not None: self.changed = set()
+        self.smoothing = smoothing
+
+    ##################################################################
+    def track_movement(self, enable = True, smoothing = 0.5):
+        """
+        Enables (or disables) movement tracking: the players that
+        spawn, move or turn are remembered until the next
+        :func:`flush`.
+
+        :param enable: Enable tracking
+        :param smoothing: Weight of the latest tick in the velocity
+                          estimate, 1 to only use the latest tick.
+
+        :type enable: bool, optional
+        :type smoothing: float, optional
+        """
+        self.changed = set() if enable else None
+        self.smoothing = smoothing
+
+    def flush(self, now = None):
+        """
+        Ends a tick: updates the velocity of the players that moved
+        since the last call and forgets them.
+
+        Players that did not move keep their previous velocity until
+        they move again, use :func:`predict` with care.
+
+        :param now: Time of the tick (:func:`time.monotonic`)
+        :type now:  float or None, optional
+
+        :return: Entity IDs of the players that moved
+        :rtype:  list[int]
+        """
+        if not self.changed: return []
+        if now is None: now = time.monotonic()
+        a = self.smoothing
+        result = []
+        for slot in self.changed:
+            x, y, z = self.x[slot], self.y[slot], self.z[slot]
+            dt = now - self.tick_time[slot]
+            if self.tick_time[slot] and dt > 0:
+                self.vx[slot] += a*((x - self.tick_x[slot])/dt -
+                                    self.vx[slot])
+                self.vy[slot] += a*((y - self.tick_y[slot])/dt -
+                                    self.vy[slot])
+                self.vz[slot] += a*((z - self.tick_z[slot])/dt -
+                                    self.vz[slot])
+            self.tick_x[slot], self.tick_y[slot], self.tick_z[slot] = \
+                x, y, z
+            self.tick_time[slot] = now
+            result.append(slot - 256 if slot > 127 else slot)
+        self.changed.clear()
+        return result
+
+    def velocity(self, pid):
+        """
+        Estimated velocity of a player, see :func:`track_movement`.
+
+        :return: Velocity in blocks per second
+        :rtype:  (float, float, float)
+        """
+        slot = pid & 0xff
+        return self.vx[slot]/32, self.vy[slot]/32, self.vz[slot]/32
+
+    def predict(self, pid, when = None):
+        """
+        Extrapolates the position of a player from its position at the
+        last tick and its velocity, useful to aim between two ticks.
+
+        :param when: Time (:func:`time.monotonic`), now if None
+        :type when:  float or None, optional
+
+        :return: Position in blocks
+        :rtype:  (float, float, float)
+        """
+        slot = pid & 0xff
+        if not self.tick_time[slot]:
+            return self.position(pid)
+        if when is None: when = time.monotonic()
+        dt = when - self.tick_time[slot]
+        return (self.tick_x[slot] + self.vx[slot]*dt)/32, \
+            (self.tick_y[slot] + self.vy[slot]*dt)/32, \
+            (self.tick_z[slot] + self.vz[slot]*dt)/32
+
+    ##################################################################
+    def name(self, pid):
+        """
+        :return: Name of a player
+        :rtype:  str or None
+        """
+        return self.names[pid & 0xff]
+
+    def position(self, pid):
+        """
+        :return: Position of a player in blocks
+        :rtype:  (float, float, float)
+        """
+        slot = pid & 0xff
+        return self.x[slot]/32, self.y[slot]/32, self.z[slot]/32
+
+    def within(self, x, y, z, radius):
+        """
+        Finds the players around a position. Only the grid cells
+        touching the sphere are looked at.
+
+        :param x: X position in blocks
+        :param y: Y position in blocks
+        :param z: Z position in blocks
+        :param radius: Radius in blocks
+
+        :type x: float
+        :type y: float
+        :type z: float
+        :type radius: float
+
+        :return: Entity IDs of the players in the sphere
+        :rtype:  list[int]
+        """
+        x, y, z, r = x*32, y*32, z*32, radius*32
+        c, r2 = self.cell, r*r
+        xs, ys, zs = self.x, self.y, self.z
+        rx = range(int((x - r) // c), int((x + r) // c) + 1)
+        ry = range(int((y - r) // c), int((y + r) // c) + 1)
+        rz = range(int((z - r) // c), int((z + r) // c) + 1)
+        if len(rx)*len(ry)*len(rz) > len(self.grid):
+            # Fewer occupied cells than cells to look at
+            cells = [s for k, s in self.grid.items()
+                     if k[0] in rx and k[1] in ry and k[2] in rz]
+        else:
+            grid = self.grid
+            cells = [grid[k] for k in
+                     ((cx, cy, cz) for cx in rx for cy in ry for cz in rz)
+                     if k in grid]
+
+        result = []
+        for cell in cells:
+            for slot in cell:
+                if (xs[slot]-x)**2 + (ys[slot]-y)**2 + \
+                   (zs[slot]-z)**2 <= r2:
+                    result.append(slot - 256 if slot > 127 else slot)
+        return result
+
+    ##################################################################
+    def get(self, pid, default = None):
+        return self[pid] if pid in self else default
+
+    def ids(self):
+        """
+        :return: Entity IDs of the players
+        :rtype:  list[int]
+        """
+        return [s - 256 if s > 127 else s
+                for s in range(256) if self.active[s]]
+
+    def items(self):
+        return [(pid, self[pid]) for pid in self.ids()]
+
+    def values(self):
+        return [self[pid] for pid in self.ids()]
+
+    def __contains__(self, pid):
+        return -128 <= pid < 128 and bool(self.active[pid & 0xff])
+
+    def __getitem__(self, pid):
+        if pid not in self:
+            raise KeyError(pid)
+        slot = pid & 0xff
+        return Player(name = self.names[slot], x = self.x[slot],
+                      y = self.y[slot], z = self.z[slot],
+                      pitch = self.pitch[slot], yaw = self.yaw[slot])
+
+    def __delitem__(self, pid):
+        if pid not in self:
+            raise KeyError(pid)
+        self.despawn(pid)
+
+    def __iter__(self):
+        return iter(self.ids())
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def __repr__(self):
+        return f"<PlayerTable of {self.count} players>"
@@ -1,23 +1,12 @@
-import asyncio, time
+import asyncio, functools, time, traceback
 import pyclassic.queue as pqueue
 import pyclassic.map as pmap
 import pyclassic.client as pclient
+import pyclassic.aclient as paclient
 import pyclassic.auth as pauth
+import pyclassic.events as pevents
 from .utils import *
-from dataclasses import dataclass
-
-@dataclass
-class Player:
-    """
-    This is a simple class to store player data such as their position,
-    their username and their head direction.
-    """
-    name: str
-    x: int
-    y: int
-    z: int
-    pitch: int
-    yaw: int
+from .players import Player, PlayerTable
 
 class PyClassic:
     """
@@ -35,6 +24,24 @@ class PyClassic:
     :param client_name: name of the client, defaults to
                         "pyclassic <VERSION>" if None
     :param build_delay: Block placing delay for multibot building
+    :param build_rate: If set, every multibot sends blocks from its
+                       own thread at this rate (blocks per second).
+                       See :class:`pyclassic.queue.ThreadedQueue`.
+    :param build_burst: Burst size of the per-bot rate limiter.
+    :param build_reach: If set, multibot builds are split in compact
+                        regions and bots only teleport when a block
+                        is out of reach.
+    :param use_asyncio: If the client is an auth object, use
+                        :class:`pyclassic.aclient.AsyncClient` for the
+                        main client so the event loop never blocks.
+    :param track_changes: Track the changes made to the downloaded
+                          map, see
+                          :func:`pyclassic.map.ClassicMap.track_changes`
+    :param index_blocks: Block IDs to index in the downloaded map, see
+                         :func:`pyclassic.map.ClassicMap.index_blocks`
+    :param move_tick: If set, movements are merged: the `on_move`
+                      event runs at most once per player every
+                      `move_tick` seconds, see :func:`handle_tick`.
 
     :type client:  :class:`pyclassic.auth.SimpleAuth` or
                    :class:`pyclassic.client.Client`
@@ -42,18 +49,29 @@ class PyClassic:
                          :class:`pyclassic.client.Client`], optional
     :type client_name: str or None, optional
     :type build_delay: float, optional
+    :type build_rate: float or None, optional
+    :type build_burst: int, optional
+    :type build_reach: float or None, optional
+    :type use_asyncio: bool, optional
+    :type track_changes: bool, optional
+    :type index_blocks: list[int] or None, optional
+    :type move_tick: float or None, optional
 
     :raise pyclassic.PyClassicError: if the client parameter is invalid.
     """
     def __init__(self, client, multibot = [], client_name = None,
-                 build_delay = 0.03, mainbot_as_worker = False):
+                 build_delay = 0.03, mainbot_as_worker = False,
+                 use_asyncio = False, build_rate = None,
+                 build_burst = 1, build_reach = None,
+                 track_changes = False, index_blocks = None,
+                 move_tick = None):
         # self.auth = auth
         if isinstance(client, pauth.SimpleAuth):
             # For backward compatibility but to also keep it
             # concise.
-            self.client = pclient.Client(
-                client, client_name = client_name)
-        elif type(client) is client.Client:
+            cls = paclient.AsyncClient if use_asyncio else pclient.Client
+            self.client = cls(client, client_name = client_name)
+        elif isinstance(client, pclient.Client):
             self.client = client
         else:
             raise PyClassicError("Invalid client argument "
@@ -63,18 +81,43 @@ class PyClassic:
         #: Queue object for multibot, None if there are no multibot.
         self.queue: pqueue.ThreadedQueue = None
         self.clones = [
-            x if type(x) is pclient.Client else
+            x if isinstance(x, pclient.Client) else
             pclient.Client(x, client_name = client_name)
             for x in multibot]
 
-        #: List of players, dynamically updated with the event system.
-        self.players: dict = {}
-        self.event_functions = {}
+        #: Players, dynamically updated with the event system.
+        #: See :class:`pyclassic.players.PlayerTable`.
+        self.players = PlayerTable()
+        self.move_tick = move_tick
+        if move_tick:
+            self.players.track_movement()
+        #: Event handlers, see :func:`event`.
+        self.events = pevents.EventDispatcher()
+        self.events.error_hook = self.handle_error
+        #: Built-in handler of every packet ID, keeping the state
+        #: (map, players, ...) up to date.
+        self.packet_handlers = [None] * 256
+        for name, handler in (
+                ("DISCONNECT", self.handle_disconnect),
+                ("SPAWN", self.handle_spawn),
+                ("DESPAWN", self.handle_despawn),
+                ("TELEPORT", self.handle_teleport),
+                ("POS", self.handle_move),
+                ("ORI", self.handle_move),
+                ("POS_ORI", self.handle_move),
+                ("LEVEL_INIT", self.handle_level_init),
+                ("LEVEL_DATA_CHUNK", self.handle_level_data_chunk),
+                ("LEVEL_FINALIZE", self.handle_level_finalize),
+                ("SET_BLOCK", self.handle_set_block),
+                ("CUSTOM_BLOCK_LEVEL", self.handle_custom_block_level)):
+            self.packet_handlers[find_packet_id(name)] = handler
         self.socket = None
         self.loop = None
         #: Map object that stores the downloaded map.
         self.map: pmap.ClassicMap = None
-        self.map_cache = b''
+        self.level = pmap.LevelAssembler()
+        self.track_changes = track_changes
+        self.index_blocks = index_blocks
         if not client_name:
             self.client_name = f"pyclassic {PYCLASSIC_VERSION}"
         else:
@@ -83,7 +126,18 @@ class PyClassic:
         if self.clones != [] or mainbot_as_worker:
             if mainbot_as_worker: self.clones.append(self.client)
             self.queue = pqueue.ThreadedQueue(self,
-                                               delay = build_delay)
+                                               delay = build_delay,
+                                               rate = build_rate,
+                                               burst = build_burst,
+                                               reach = build_reach)
+
+    @property
+    def is_async(self):
+        """
+        True if the main client is a
+        :class:`pyclassic.aclient.AsyncClient`.
+        """
+        return isinstance(self.client, paclient.AsyncClient)
 
     ##################################################################
     def log(self, *msg):
@@ -106,24 +160,127 @@ class PyClassic:
                 return t
         elif name.startswith(pref):
             t = name[len(pref):].lower()
-            if t in ['recv', 'connect', 'move', 'set_block', 'event']:
+            if t in ['recv', 'connect', 'move', 'set_block', 'event',
+                     'error']:
                 return t
         return None
         
-    def event(self, fn):
+    def event(self, fn = None, priority = 0, name = None):
         """
-        Decorator to define an event.
+        Decorator to define an event. An event can have any amount of
+        functions, they run one after the other (not concurrently) by
+        decreasing priority, see :mod:`pyclassic.events`.
+
+        Example::
+
+            @bot.event
+            async def on_packet_message(pid, message): ...
+
+            @bot.event(priority = 10)
+            async def on_set_block(x, y, z, bid, old): ...
 
         :param fn: Event function. The function must be named as the
                    wanted event.
+        :param priority: Priority of the function
+        :param name: Event name to use instead of the function name
+
         :type fn: function
+        :type priority: int, optional
+        :type name: str or None, optional
+
+        :return: The function. Functions with an unknown event name
+                 are ignored.
         """
-        n = fn.__name__
-        t = self.get_event_name(n)
+        if fn is None:
+            return lambda fn: self.event(fn, priority, name)
+        t = self.get_event_name(name or fn.__name__)
+        if t is None:
+            return fn
 
-        if t:
-            self.event_functions[t] = fn
-    ##################################################################
+        self.events.add(t, fn, priority)
+        self.update_routing()
+        return fn
+
+    def remove_event(self, fn, name = None):
+        """
+        Removes an event function.
+
+        :param fn: Event function, see :func:`event`
+        :param name: Event name to use instead of the function name
+
+        :type fn: function
+        :type name: str or None, optional
+        """
+        t = self.get_event_name(name or fn.__name__)
+        if t is None: return
+        self.events.remove(t, fn)
+        self.update_routing()
+
+    @property
+    def event_functions(self):
+        """
+        Event functions as a dict with one function per event, like
+        before events could have several functions. See
+        :class:`pyclassic.events.HandlerView`, prefer :attr:`events`.
+        """
+        return pevents.HandlerView(self.events, self.update_routing)
+
+    def set_policy(self, name, max_in_flight = None, overflow = "wait",
+                   max_pending = 64, key = None):
+        """
+        Limits the amount of running tasks of an event, see
+        :class:`pyclassic.events.EventPolicy`.
+
+        Example::
+
+            # At most 4 movement tasks, only the latest movement of
+            # each player is kept when they are all busy.
+            bot.set_policy("on_move", 4, "coalesce",
+                           key = lambda args: args[1])
+
+        :param name: Event name, as a function name (`"on_move"`)
+
+        :type name: str
+
+        :raise pyclassic.PyClassicError: Invalid event name.
+        """
+        t = self.get_event_name(name)
+        if t is None:
+            raise PyClassicError("Invalid event name.")
+        self.events.set_policy(t, pevents.EventPolicy(
+            max_in_flight, overflow, max_pending, key))
+
+    def handle_error(self, event, fn, exception):
+        """
+        Error hook of the event functions: runs the `on_error` event
+        functions with the event and the exception, or prints the
+        traceback if there are none. Used internally.
+        """
+        if event == "error" or "error" not in self.events:
+            self.die(f"Exception in {fn.__name__}:")
+            traceback.print_exception(type(exception), exception,
+                                      exception.__traceback__)
+        else:
+            self.run_event("error", event, exception)
+
+    def update_routing(self):
+        """
+        Tells the clients (including the multibot clients) which
+        packets must be decoded: the ones with a built-in handler or an
+        event function. The other packets are received but never
+        decoded. Used internally.
+        """
+        if "recv" in self.events:
+            decode = None
+        else:
+            decode = bytearray(256)
+            for pid in self.events.packet_ids():
+                decode[pid] = 1
+            for pid, handler in enumerate(self.packet_handlers):
+                if handler: decode[pid] = 1
+        self.client.decode = decode
+        for clone in self.clones:
+            clone.decode = decode
 
     def recv(self):
         """
@@ -131,6 +288,12 @@ class PyClassic:
         """
         return self.client.recv()
 
+    def recv_many(self):
+        """
+        see :func:`pyclassic.client.Client.recv_many`
+        """
+        return self.client.recv_many()
+
     def send(self, pid, *args):
         """
         see :func:`pyclassic.client.Client.send`
@@ -140,11 +303,14 @@ class PyClassic:
 
     async def asend(self, pid, *args):
         """
-        Actually not very useful, sends stuff but asynchronously.
+        Sends stuff but asynchronously. With an asynchronous client it
+        also waits for the data to be flushed.
 
         see :func:`pyclassic.PyClassic.send`
         """
         self.send(pid, *args)
+        if self.is_async:
+            await self.client.drain()
     def get_block(self, x, y, z):
         """
         Retrieve a block from `self.map`
@@ -208,20 +374,26 @@ class PyClassic:
                       pitch = None,
                       yaw = None,
                       relative = False):
+        """
+        Updates a player of :attr:`players`, adding it if it is
+        unknown. Positions are in 1/32 of a block, they are offsets if
+        `relative` is true. Missing values are left unchanged.
+        """
+        p = self.players
         name = sanitize(name) if name else None
-        dtz = lambda n: 0 if None else n
-        x, y, z, pitch, yaw = [dtz(_) for _ in (x,y,z,pitch,yaw)]
-        if playerid not in self.players:
-            self.players[playerid] = Player(name,x,y,z,pitch,yaw)
+        if playerid not in p:
+            p.spawn(playerid, name, x or 0, y or 0, z or 0,
+                    yaw or 0, pitch or 0)
             return
-        p = self.players[playerid]
-        
-        if name: p.name = name
-        if x: p.x = p.x+x if relative and p.x else x
-        if y: p.y = p.y+y if relative and p.y else y
-        if z: p.z = p.z+z if relative and p.z else z
-        if pitch: p.pitch = pitch
-        if yaw: p.yaw = yaw
+
+        if name: p.rename(playerid, name)
+        if x is not None:
+            if relative:
+                p.move(playerid, x, y, z)
+            else:
+                p.teleport(playerid, x, y, z)
+        if yaw is not None:
+            p.turn(playerid, yaw, pitch)
 
     ##################################################################
     def disconnect(self):
@@ -233,7 +405,8 @@ class PyClassic:
         return self.client.disconnect()
     def connect(self, **kargs):
         """
-        Connects the main client to a server.
+        Connects the main client to a server. With an asynchronous
+        client, the returned coroutine must be awaited.
 
         see :func:`pyclassic.client.Client.connect`
         """
@@ -260,6 +433,148 @@ class PyClassic:
     ##################################################################
     ##################################################################
 
+    def run_event(self, name, *args):
+        """
+        Schedules the functions of an event if there are some,
+        according to the policy of the event (see :func:`set_policy`).
+
+        :param name: Event name or packet ID
+        :param args: Arguments to give to the event functions
+        """
+        self.events.fire(name, args)
+
+    async def handle_packet(self, info, packet):
+        """
+        Handles a received packet: runs the events and keeps the
+        state (map, players, ...) up to date.
+
+        :param info: Packet information
+        :param packet: Decoded packet, None if it has not been decoded
+
+        :type info:   :class:`pyclassic.utils.PacketFormat`
+        :type packet: list or None
+
+        :return: False if the event loop must stop.
+        :rtype:  bool or None
+        """
+        if packet is None: return
+        if self.events.handlers:
+            self.run_event("recv", info, packet)
+            self.events.fire(info.pid, packet)
+
+        handler = self.packet_handlers[info.pid]
+        if handler:
+            return await handler(info, packet)
+
+    async def handle_disconnect(self, info, packet):
+        self.die("Kicked!", packet[0])
+        return False
+
+    async def handle_spawn(self, info, packet):
+        pid, name, x, y, z, yaw, pitch = packet
+        self.players.spawn(pid, sanitize(name), x, y, z, yaw, pitch)
+
+    async def handle_despawn(self, info, packet):
+        self.players.despawn(packet[0])
+
+    async def handle_teleport(self, info, packet):
+        if "move" in self.events and not self.move_tick:
+            self.run_event("move", info.name, *packet)
+        if packet[0] == -1:
+            await self.move(packet[1]//32,
+                            packet[2]//32 + 2,
+                            packet[3]//32)
+        self.players.teleport(*packet)
+
+    async def handle_move(self, info, packet):
+        pid = packet[0]
+        if "move" in self.events and not self.move_tick:
+            newpos = [None, None, None]
+            newangle = [None, None]
+            if info.name == "POS":
+                newpos = packet[1:]
+            elif info.name == "ORI":
+                newangle = packet[1:]
+            elif info.name == "POS_ORI":
+                newpos = packet[1:4]
+                newangle = packet[4:]
+            self.run_event("move", info.name, pid, *(newpos+newangle))
+
+        if pid not in self.players:
+            # Never spawned: added anyway like update_player does, the
+            # offsets become its position.
+            self.players.spawn(pid, None, 0, 0, 0)
+        if info.name == "ORI":
+            self.players.turn(pid, packet[1], packet[2])
+        else:
+            self.players.move(pid, packet[1], packet[2], packet[3])
+            if info.name == "POS_ORI":
+                self.players.turn(pid, packet[4], packet[5])
+
+    async def handle_level_init(self, info, packet):
+        self.level.reset()
+
+    async def handle_level_data_chunk(self, info, packet):
+        sz = packet[0]
+        self.level.feed(packet[1][:sz])
+
+    async def handle_level_finalize(self, info, packet):
+        w, h, l = packet
+        self.map = self.level.finalize(w, h, l)
+        if self.track_changes:
+            self.map.track_changes()
+        if self.index_blocks:
+            self.map.index_blocks(self.index_blocks)
+        if self.queue:
+            self.queue.map = self.map
+
+    async def handle_set_block(self, info, packet):
+        if not self.map: return
+        x, y, z, block_id = packet
+        self.run_event("set_block", x, y, z, block_id,
+                       self.map[x, y, z])
+        self.map[x, y, z] = block_id
+
+    async def handle_custom_block_level(self, info, packet):
+        self.send(0x13, 1)
+
+    def handle_tick(self, now = None):
+        """
+        Runs the `on_move` event once for every player that moved
+        since the last tick, with `"TICK"` as packet name and the
+        absolute position and direction of the player.
+        :func:`event_loop` calls it every `move_tick` seconds from a
+        timer. With a synchronous client, packets are then received in
+        an executor so that the asyncio loop is never blocked between
+        ticks.
+
+        The estimated velocity of the players is available with
+        :func:`pyclassic.players.PlayerTable.velocity`.
+
+        :param now: Time of the tick (:func:`time.monotonic`)
+        :type now:  float or None, optional
+        """
+        p = self.players
+        moved = p.flush(now)
+        if "move" not in self.events: return
+        for pid in moved:
+            if pid not in p: continue
+            slot = pid & 0xff
+            self.run_event("move", "TICK", pid, p.x[slot], p.y[slot],
+                           p.z[slot], p.yaw[slot], p.pitch[slot])
+
+    async def tick_loop(self):
+        """
+        Calls :func:`handle_tick` every `move_tick` seconds. Used
+        internally.
+        """
+        loop = asyncio.get_running_loop()
+        tick = loop.time()
+        while True:
+            tick = max(tick + self.move_tick, loop.time())
+            await asyncio.sleep(tick - loop.time())
+            self.handle_tick()
+
     async def event_loop(self):
         """
         Runs the asynchronous event loop.
@@ -269,78 +584,40 @@ class PyClassic:
             are doing cursed shit.
             See :func:`pyclassic.PyClassic.run`
         """
-        def run_event(name, *args):
-            fn = self.event_functions.get(name)
-            if fn:
-                task = asyncio.ensure_future(fn(*args))
-
+        ticker = None
         try:
-            run_event("connect")
+            if self.move_tick:
+                ticker = asyncio.ensure_future(self.tick_loop())
+            self.update_routing()
+            self.run_event("connect")
+            loop = asyncio.get_running_loop()
             while True:
-                info, packet = self.recv()
-                run_event("recv", info, packet)
-                run_event(info.pid, *packet)
-                
-                if info.name == "DISCONNECT":
-                    self.die("Kicked!", packet[0])
-                    self.loop.stop()
-                    return
-                elif info.name == "SPAWN":
-                    self.update_player(*packet)
-                elif info.name == "DESPAWN":
-                    if self.players.get(packet[0]):
-                        del self.players[packet[0]]
-
-                elif info.name == "TELEPORT":
-                    run_event("move", info.name, *packet)
-                    if packet[0] == -1:
-                        await self.move(packet[1]//32,
-                                        packet[2]//32 + 2,
-                                        packet[3]//32)
-                    self.update_player(packet[0], None, *packet[1:])
-                elif info.name in ["POS", "ORI", "POS_ORI"]:
-                    pid = packet[0]
-                    newpos = [None, None, None]
-                    newangle = [None, None]
-                    if info.name == "POS":
-                        newpos = packet[1:]
-                    elif info.name == "ORI":
-                        newangle = packet[1:]
-                    elif info.name == "POS_ORI":
-                        newpos = packet[1:4]
-                        newangle = packet[4:]
-
-                    run_event("move", info.name, pid, *(newpos+newangle))
-                    self.update_player(pid, None, *(newpos+newangle),
-                                       True)
-
-                elif info.name == 'LEVEL_INIT':
-                    self.map_cache = b''
-                elif info.name == 'LEVEL_DATA_CHUNK':
-                    sz = packet[0]
-                    self.map_cache += packet[1][:sz]
-                elif info.name == 'LEVEL_FINALIZE':
-                    w, h, l = packet
-                    self.map = pmap.ClassicMap(
-                        self.map_cache, w, h, l)
-                    self.map_cache = b''
-                    if self.queue:
-                        self.queue.map = self.map
-                elif info.name == 'SET_BLOCK' and self.map:
-                    x, y, z, block_id = packet
-                    run_event("set_block", x, y, z, block_id,
-                              self.map[x, y, z])
-                    self.map[x, y, z] = block_id
-                elif info.name == "CUSTOM_BLOCK_LEVEL":
-                    self.send(0x13, 1)
+                if self.is_async:
+                    packets = [await self.client.recv()]
+                elif self.move_tick:
+                    # Receive in a thread so that the ticks do not
+                    # depend on the incoming traffic.
+                    packets = await loop.run_in_executor(
+                        None, lambda: list(self.recv_many()))
+                else:
+                    packets = self.recv_many()
+                for info, packet in packets:
+                    if await self.handle_packet(info, packet) is False:
+                        return
                 await asyncio.sleep(0)
+                await self.events.wait_ready()
         except KeyboardInterrupt:
-            self.loop.stop()
+            if self.loop: self.loop.stop()
             return
+        finally:
+            if ticker: ticker.cancel()
     ##################################################################
-    def run(self, delay = 4, **kargs): # TODO: finish
+    async def start(self, delay = 4, **kargs):
         """
-        Connects all clients and run the event loop.
+        Connects all clients and runs the event loop in the running
+        asyncio loop. Unlike :func:`pyclassic.PyClassic.run`, this
+        lets multiple bots share the same loop, for example with
+        :func:`asyncio.gather`.
 
         :param delay: Delay of connection between each multibot
                       connection.
@@ -348,18 +625,33 @@ class PyClassic:
                       It depends of the :class:`pyclassic.auth`
                       class.
         """
-        err = None
-        if not self.client.socket: self.connect(**kargs)
-        if self.clones: self.connect_multibot(delay = delay, **kargs)
-            
-        self.loop = asyncio.get_event_loop()
-        # self.loop.create_task(self.event_loop())
+        loop = asyncio.get_running_loop()
         try:
-            self.loop.run_until_complete(self.event_loop())
-        except Exception as e:
-            err = e
+            if not self.client.socket:
+                if self.is_async:
+                    await self.connect(**kargs)
+                else:
+                    await loop.run_in_executor(
+                        None, functools.partial(self.connect, **kargs))
+            if self.clones:
+                await loop.run_in_executor(
+                    None, functools.partial(self.connect_multibot,
+                                            delay = delay, **kargs))
+
+            self.loop = loop
+            await self.event_loop()
+        finally:
+            self.loop = None
+            self.disconnect()
 
-        self.loop = None
+    def run(self, delay = 4, **kargs): # TODO: finish
+        """
+        Connects all clients and run the event loop.
 
-        self.disconnect()
-        if err: raise err
+        :param delay: Delay of connection between each multibot
+                      connection.
+        :param kargs: Arguments such as the IP address, port, etc.
+                      It depends of the :class:`pyclassic.auth`
+                      class.
+        """
+        asyncio.run(self.start(delay = delay, **kargs))
@@ -11,22 +11,365 @@ anti-grief policies, this module is for you.
     Some servers may IP-ban you :) Make sure to only use it on
     unmoderated servers. Or maybe you can do a little trolling while
     no one is connected :troll:
+
+.. note::
+    Queues are :class:`BlockQueue` objects, not lists of
+    :class:`Block` anymore. This is also what :func:`pyclassic.extra.cuboid`,
+    :func:`pyclassic.extra.hollow`, :func:`pyclassic.extra.pyramid`,
+    :func:`pyclassic.map.ClassicMap.get_queue` and the batch system
+    return. A :class:`BlockQueue` can still be indexed and iterated
+    like a list, but the :class:`Block` objects it gives are copies:
+    modifying them does not change the queue. Use
+    :func:`BlockQueue.shift`, :func:`BlockQueue.filter` or
+    :func:`BlockQueue.mask` instead.
 """
 import threading, time
+from array import array
+from collections import deque
+from itertools import compress
 from dataclasses import dataclass
 
 class QueueError(Exception): pass
 
+# Spreads the 8 bits of a byte every 3 bits, used for Morton codes.
+_morton_table = [sum(((n >> i) & 1) << (3*i) for i in range(8))
+                 for n in range(256)]
+
+def morton(x, y, z):
+    """
+    Computes the Morton code (Z-order curve) of a position. Blocks
+    sorted by Morton code are grouped in small cubic regions.
+
+    :type x: int
+    :type y: int
+    :type z: int
+    :rtype: int
+    """
+    t = _morton_table
+    x, y, z = x + 0x8000, y + 0x8000, z + 0x8000
+    return (t[x & 0xff] | t[y & 0xff] << 1 | t[z & 0xff] << 2) | \
+        (t[x >> 8] | t[y >> 8] << 1 | t[z >> 8] << 2) << 24
+
 @dataclass
 class Block:
     """
     A single block.
     """
+    __slots__ = ('x', 'y', 'z', 'bid')
+
     x: int
     y: int
     z: int
     bid: int
 
+class BlockQueue:
+    """
+    A compact block queue. Instead of storing a list of
+    :class:`pyclassic.queue.Block`, it stores the coordinates and the
+    block IDs in arrays which takes way less memory. It can be used
+    like a list of blocks, :class:`pyclassic.queue.Block` objects are
+    only made when the blocks are read.
+
+    :param blocks: Blocks to fill the queue with
+    :type blocks:  iterable[:class:`pyclassic.queue.Block`], optional
+    """
+    def __init__(self, blocks = ()):
+        self.x = array('h')
+        self.y = array('h')
+        self.z = array('h')
+        self.bid = array('B')
+        for block in blocks:
+            self.append(block)
+
+    @classmethod
+    def from_arrays(cls, x, y, z, bid):
+        """
+        Makes a queue from the columns of coordinates and block IDs.
+
+        :param x: X positions
+        :param y: Y positions
+        :param z: Z positions
+        :param bid: Block IDs
+
+        :type x: iterable[int]
+        :type y: iterable[int]
+        :type z: iterable[int]
+        :type bid: iterable[int]
+
+        :rtype: :class:`pyclassic.queue.BlockQueue`
+        """
+        q = cls()
+        q.x.extend(x)
+        q.y.extend(y)
+        q.z.extend(z)
+        q.bid.extend(bid)
+        if not len(q.x) == len(q.y) == len(q.z) == len(q.bid):
+            raise QueueError("Columns must have the same length.")
+        return q
+
+    def add(self, x, y, z, bid):
+        """
+        Adds a block at the end of the queue.
+
+        :type x: int
+        :type y: int
+        :type z: int
+        :type bid: int
+        """
+        self.x.append(x)
+        self.y.append(y)
+        self.z.append(z)
+        self.bid.append(bid)
+
+    def append(self, block):
+        """
+        Adds a block at the end of the queue.
+
+        :type block: :class:`pyclassic.queue.Block`
+        """
+        self.add(block.x, block.y, block.z, block.bid)
+
+    def extend(self, blocks):
+        """
+        Adds blocks at the end of the queue.
+
+        :param blocks: Blocks to add
+        :type blocks:  :class:`pyclassic.queue.BlockQueue` or
+                       iterable[:class:`pyclassic.queue.Block`]
+        """
+        if isinstance(blocks, BlockQueue):
+            self.x.extend(blocks.x)
+            self.y.extend(blocks.y)
+            self.z.extend(blocks.z)
+            self.bid.extend(blocks.bid)
+        else:
+            for block in blocks:
+                self.append(block)
+
+    def extend_ranges(self, xs, ys, zs, bid):
+        """
+        Adds every block of the cuboid made by three ranges, in the X,
+        Y then Z order. The columns are built in bulk without making
+        any block.
+
+        :param xs: X positions
+        :param ys: Y positions
+        :param zs: Z positions
+        :param bid: Block ID
+
+        :type xs: range
+        :type ys: range
+        :type zs: range
+        :type bid: int
+        """
+        nz = len(zs)
+        zcol = array('h', zs)
+        for x in xs:
+            xcol = array('h', [x]) * nz
+            for y in ys:
+                self.x.extend(xcol)
+                self.y.extend(array('h', [y]) * nz)
+                self.z.extend(zcol)
+        self.bid.extend(array('B', [bid]) * (len(xs) * len(ys) * nz))
+
+    def add_row(self, xs, y, z, bid):
+        """
+        Adds a row of blocks along X, in bulk.
+
+        :param xs: X positions
+        :type xs:  range
+        :type y: int
+        :type z: int
+        :type bid: int
+        """
+        n = len(xs)
+        self.x.extend(array('h', xs))
+        self.y.extend(array('h', [y]) * n)
+        self.z.extend(array('h', [z]) * n)
+        self.bid.extend(array('B', [bid]) * n)
+
+    def mask(self, selectors):
+        """
+        Keeps the blocks for which the corresponding selector is
+        true.
+
+        :param selectors: One boolean per block
+        :type selectors:  iterable[bool]
+
+        :return: The filtered queue
+        :rtype:  :class:`pyclassic.queue.BlockQueue`
+        """
+        selectors = bytes(map(bool, selectors))
+        return BlockQueue.from_arrays(compress(self.x, selectors),
+                                      compress(self.y, selectors),
+                                      compress(self.z, selectors),
+                                      compress(self.bid, selectors))
+
+    def filter(self, fn):
+        """
+        Keeps the blocks for which the function returns true.
+
+        :param fn: Predicate taking a :class:`pyclassic.queue.Block`
+        :type fn:  function
+
+        :return: The filtered queue
+        :rtype:  :class:`pyclassic.queue.BlockQueue`
+        """
+        return self.mask(map(fn, self))
+
+    def shift(self, ox = 0, oy = 0, oz = 0):
+        """
+        Moves every block of the queue by an offset, in place.
+
+        :type ox: int, optional
+        :type oy: int, optional
+        :type oz: int, optional
+        """
+        if ox: self.x = array('h', map(ox.__add__, self.x))
+        if oy: self.y = array('h', map(oy.__add__, self.y))
+        if oz: self.z = array('h', map(oz.__add__, self.z))
+
+    def spatial_order(self):
+        """
+        Sorts the blocks along a Z-order curve (see
+        :func:`pyclassic.queue.morton`) so that consecutive blocks are
+        close to each other. Any contiguous part of the sorted queue
+        is a compact region.
+
+        :return: The sorted queue
+        :rtype:  :class:`pyclassic.queue.BlockQueue`
+        """
+        keys = list(map(morton, self.x, self.y, self.z))
+        order = sorted(range(len(keys)), key = keys.__getitem__)
+        return BlockQueue.from_arrays(map(self.x.__getitem__, order),
+                                      map(self.y.__getitem__, order),
+                                      map(self.z.__getitem__, order),
+                                      map(self.bid.__getitem__, order))
+
+    def pop(self, i = -1):
+        """
+        Removes a block from the queue and returns it.
+
+        :param i: Index
+        :type i:  int, optional
+        :rtype: :class:`pyclassic.queue.Block`
+        """
+        return Block(self.x.pop(i), self.y.pop(i), self.z.pop(i),
+                     self.bid.pop(i))
+
+    def copy(self):
+        """
+        :return: A copy of the queue
+        :rtype:  :class:`pyclassic.queue.BlockQueue`
+        """
+        return self[:]
+
+    def __len__(self):
+        return len(self.bid)
+
+    def __iadd__(self, blocks):
+        self.extend(blocks)
+        return self
+
+    def __add__(self, blocks):
+        q = self.copy()
+        q.extend(blocks)
+        return q
+
+    def __iter__(self):
+        return map(Block, self.x, self.y, self.z, self.bid)
+
+    def __getitem__(self, i):
+        if type(i) == slice:
+            q = BlockQueue()
+            q.x, q.y, q.z = self.x[i], self.y[i], self.z[i]
+            q.bid = self.bid[i]
+            return q
+        return Block(self.x[i], self.y[i], self.z[i], self.bid[i])
+
+    def __repr__(self):
+        return f"<BlockQueue of {len(self)} blocks>"
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Tokens are refilled continuously at the
+    given rate and the bucket can hold up to `burst` tokens, allowing
+    short bursts while keeping the average rate.
+
+    :param rate:  Tokens (blocks) per second
+    :param burst: Size of the bucket
+
+    :type rate:  float
+    :type burst: int, optional
+    """
+    def __init__(self, rate, burst = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def take(self, n = 1, event = None):
+        """
+        Takes tokens from the bucket, waits until there are enough.
+
+        :param n:     Amount of tokens
+        :param event: If set while waiting, gives up.
+
+        :type n:     int, optional
+        :type event: :class:`threading.Event`, optional
+
+        :return: False if it gave up because of the event.
+        :rtype:  bool
+        """
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last)*self.rate)
+            self.last = now
+            if self.tokens >= n:
+                self.tokens -= n
+                return True
+
+            wait = (n - self.tokens) / self.rate
+            if event:
+                if event.wait(wait): return False
+            else:
+                time.sleep(wait)
+
+class QueueStream:
+    """
+    A queue built lazily by parts, so that a huge build can start
+    right away and only takes the memory of one part. See
+    :func:`pyclassic.queue.ThreadedQueue.add_queue`.
+
+    :param stream: Blocks or queues, or a shape (see
+                   :class:`pyclassic.extra.Shape`) which is then
+                   built by parts in bulk.
+    :param size:   Size of the parts
+
+    :type stream: iterable[:class:`pyclassic.queue.Block` or
+                           :class:`pyclassic.queue.BlockQueue`]
+    :type size:   int, optional
+    """
+    def __init__(self, stream, size = 4096):
+        self.size = size
+        queues = getattr(stream, "queues", None)
+        self.iterator = iter(queues(size) if queues else stream)
+
+    def next_queue(self):
+        """
+        :return: The next part, empty if the stream is exhausted
+        :rtype:  :class:`pyclassic.queue.BlockQueue`
+        """
+        q = BlockQueue()
+        for item in self.iterator:
+            if isinstance(item, BlockQueue):
+                q += item
+            else:
+                q.append(item)
+            if len(q) >= self.size: break
+        return q
+
 class ThreadedQueue:
     """
     The class that does all the queue job.
@@ -41,26 +384,56 @@ class ThreadedQueue:
                    will take the bot array from it.
     :param delay:  The delay, defaults to 0.03s (30ms) as it is the
                    usual delay to bypass the anti-grief system.
+    :param rate:   If set, every bot gets its own sender thread
+                   limited to this amount of blocks per second instead
+                   of sending all blocks from one thread with `delay`.
+    :param burst:  Burst size of the per-bot rate limiter.
+    :param chunk:  Size of the work chunks in per-bot mode. Bots get a
+                   contiguous part of the chunks and idle bots steal
+                   chunks from the others.
+    :param reach:  If set, queues are sorted spatially when added (see
+                   :func:`pyclassic.queue.BlockQueue.spatial_order`)
+                   and bots only teleport when the next block is
+                   farther than this distance. Combined with `rate`,
+                   every bot builds its own compact region.
     
     :type player:  :class:`pyclassic.PyClassic` or a list of
                    :class:`pyclassic.client.Client` instances.
     :type delay:   float, optional
     :type map:     :class:`pyclassic.map.ClassicMap`, optional
+    :type rate:    float or None, optional
+    :type burst:   int, optional
+    :type chunk:   int, optional
+    :type reach:   float or None, optional
     :raise pyclassic.queue.QueueError: The list is empty or the
                                        PyClassic instance has no
                                        bot array.
     """
-    def __init__(self, player, map = None, delay = 0.03):
+    def __init__(self, player, map = None, delay = 0.03,
+                 rate = None, burst = 1, chunk = 64, reach = None):
         self.current_queue = None
-        self.queues = []
+        #: Amount of blocks placed in the current queue. This is also
+        #: the index of the next block when there is one sender.
+        self.progress = 0
+        self.queues = deque()
         self.thread = None
         self.thread_event = None
         self.delay = delay
 
+        self.rate = rate
+        self.burst = burst
+        self.chunk = chunk
+        self.reach = reach
+        # Per-bot work: one deque of (start, end) ranges per bot.
+        self.chunks = None
+        #: Stream the current queue is a part of, if any.
+        self.stream = None
+        self.lock = threading.Lock()
+        #: Exceptions raised by the bots during the last per-bot run.
+        self.errors = []
+
         if type(player).__name__ == "PyClassic":
             self.map = player.map
-            print(player.map)
-            print(self.map)
 
             if player.clones:
                 self.bots = player.clones
@@ -99,16 +472,47 @@ class ThreadedQueue:
         """
         Adds a queue to the job queue.
 
-        :param queue: Block queue
-        :type queue:  list[:class:`pyclassic.queue.Block`]
+        :param queue: Block queue, it is converted to a
+                      :class:`pyclassic.queue.BlockQueue` if needed.
+                      Any other iterable such as a generator or a
+                      shape (see :class:`pyclassic.extra.Shape`) is
+                      added as a :class:`pyclassic.queue.QueueStream`
+                      and only consumed while it is being built.
+        :type queue:  :class:`pyclassic.queue.BlockQueue` or
+                      list[:class:`pyclassic.queue.Block`] or
+                      :class:`pyclassic.queue.QueueStream` or
+                      iterable
         """
         self.check_lock()
-        
+
+        if isinstance(queue, QueueStream):
+            self.queues.append(queue)
+            return
+        if not isinstance(queue, (BlockQueue, list, tuple)):
+            self.queues.append(QueueStream(queue))
+            return
+        if not isinstance(queue, BlockQueue):
+            queue = BlockQueue(queue)
+        elif not self.map and self.reach is None:
+            queue = queue.copy()
+        self.queues.append(self.prepare(queue))
+
+    def prepare(self, queue):
+        """
+        Removes the blocks that are already placed on the map and
+        sorts the queue if needed. Used internally.
+
+        :rtype: :class:`pyclassic.queue.BlockQueue`
+        """
         if self.map:
-            self.queues.append([x for x in queue
-                                if self.map[x.x, x.y, x.z] != x.bid])
-        else:
-            self.queues.append(queue.copy())
+            m = self.map
+            queue = queue.mask(
+                m[x, y, z] != bid for x, y, z, bid in
+                zip(queue.x, queue.y, queue.z, queue.bid))
+        if self.reach is not None:
+            queue = queue.spatial_order()
+        return queue
+
     def remove_queue(self, i):
         """
         Removes a queue from the job queue.
@@ -117,24 +521,42 @@ class ThreadedQueue:
         :type i:  int
         """
         self.check_lock()
-        if i > len(self.queues):
+        if i >= len(self.queues):
             raise QueueError("This queue does not exist.")
-        self.queues.pop(i)
+        del self.queues[i]
 
     def clear_queues(self):
         """
         Clear the whole job queue along with the current queue.
         """
         self.check_lock()
-        self.queues = []
+        self.queues = deque()
         self.current_queue = None
+        self.stream = None
+        self.progress = 0
+        self.chunks = None
 
     def clear_current_queue(self):
         """
-        Clears only the current queue.
+        Clears only the current queue (or stream).
         """
         self.check_lock()
         self.current_queue = None
+        self.stream = None
+        self.progress = 0
+        self.chunks = None
+
+    def remaining(self):
+        """
+        Amount of blocks left to place in the current queue. Stopping
+        the thread keeps the progress, starting it again resumes the
+        current queue where it stopped.
+
+        :return: Blocks left in the current queue
+        :rtype:  int
+        """
+        if not self.current_queue: return 0
+        return len(self.current_queue) - self.progress
 
     def do_blockqueue(self, threaded = True):
         """
@@ -150,27 +572,184 @@ class ThreadedQueue:
         :param threaded: is it running in a thread?
         :type threaded:  bool, optional
         """
-        if not self.current_queue:
-            if not self.queues: return
+        if not self.remaining() and not self.next_queue():
+            return
+
+        if self.reach is not None:
+            for bot in self.bots: bot.reach = self.reach
+
+        try:
+            while True:
+                if self.rate:
+                    self.run_workers()
+                else:
+                    self.send_blocks()
+                if not self.stream or (self.thread_event != None and
+                                       self.thread_event.is_set()):
+                    break
+                # Go on with the next part of the stream
+                part = self.stream.next_queue()
+                if not len(part):
+                    self.stream = None
+                    break
+                self.set_current_queue(self.prepare(part))
+        finally:
+            if threaded and self.thread and \
+               not self.thread_event.is_set():
+                self.thread = None
+                self.thread_event = None
+
+    def set_current_queue(self, queue):
+        """
+        Makes a queue the current queue. Used internally.
+        """
+        self.current_queue = queue
+        self.progress = 0
+        self.chunks = None
+
+    def next_queue(self):
+        """
+        Pops the next queue from the job queue, or takes the next part
+        of the current stream. Used internally.
+
+        :return: False if there is nothing left to build.
+        :rtype:  bool
+        """
+        while True:
+            if self.stream:
+                part = self.stream.next_queue()
+                if len(part):
+                    self.set_current_queue(self.prepare(part))
+                    return True
+                self.stream = None
+            if not self.queues:
+                return False
+            job = self.queues.popleft()
+            if isinstance(job, QueueStream):
+                self.stream = job
             else:
-                self.current_queue = self.queues.pop(0)
+                self.set_current_queue(job)
+                return True
 
+    def send_blocks(self):
+        """
+        Sends the current queue from this thread, going through the
+        bots one block at a time with `delay`. Used internally.
+        """
         delay = self.delay # / len(self.bots)
         bot_id = 0
-        while self.current_queue != []:
+        q = self.current_queue
+        xs, ys, zs, bids = q.x, q.y, q.z, q.bid
+        size = len(q)
+        while self.progress < size:
             if self.thread_event != None and \
                self.thread_event.is_set():
                 break
-            if bot_id == 0:
+            if bot_id == 0 and delay:
                 time.sleep(delay)
-            block = self.current_queue.pop(0)
-            x, y, z, bid = block.x, block.y, block.z, block.bid
-            self.bots[bot_id].set_block(x, y, z, bid)
+            i = self.progress
+            self.bots[bot_id].set_block(xs[i], ys[i], zs[i], bids[i])
+            self.progress = i + 1
             bot_id = (bot_id+1)%len(self.bots)
 
-        if threaded and self.thread and not self.thread_event.is_set():
-            self.thread = None
-            self.thread_event = None
+    def split_work(self):
+        """
+        Splits the current queue into chunks and gives every bot a
+        contiguous part of them. Used internally.
+
+        :return: One deque of (start, end) ranges per bot
+        :rtype:  list[collections.deque]
+        """
+        size, n = len(self.current_queue), len(self.bots)
+        ranges = [(i, min(i + self.chunk, size))
+                  for i in range(self.progress, size, self.chunk)]
+        per_bot = -(-len(ranges) // n)
+        return [deque(ranges[i*per_bot:(i+1)*per_bot]) for i in range(n)]
+
+    def steal_work(self):
+        """
+        Takes a chunk from the bot with the most work left. Used
+        internally by idle bots.
+
+        :return: A (start, end) range or None if there is no work left.
+        :rtype:  (int, int) or None
+        """
+        while True:
+            victim = max(self.chunks, key = len)
+            try:
+                return victim.pop()
+            except IndexError:
+                if not any(self.chunks): return None
+
+    def worker(self, bot_id, bucket, event):
+        """
+        Sender thread of a bot in per-bot mode. Used internally.
+        """
+        bot, own = self.bots[bot_id], self.chunks[bot_id]
+        q = self.current_queue
+        xs, ys, zs, bids = q.x, q.y, q.z, q.bid
+        while not event.is_set():
+            try:
+                start, end = own.popleft()
+            except IndexError:
+                work = self.steal_work()
+                if not work: return
+                start, end = work
+
+            # Blocks are sent by bursts: a whole rate limiter window
+            # is sent at once.
+            n = min(end - start, self.burst)
+            if not bucket.take(n, event):
+                own.appendleft((start, end))
+                return
+            # Put the rest back first so it can be stolen if this bot
+            # is slow to send.
+            stop = start + n
+            if stop < end:
+                own.appendleft((stop, end))
+            try:
+                with bot.batch():
+                    for i in range(start, stop):
+                        bot.set_block(xs[i], ys[i], zs[i], bids[i])
+            except Exception as e:
+                # The burst is only sent when the batch is flushed, so
+                # none of it can be trusted: give it all back to the
+                # other bots (placing a block twice is harmless) and
+                # stop this one.
+                own.appendleft((start, stop))
+                with self.lock:
+                    self.errors.append(e)
+                return
+            with self.lock:
+                self.progress += n
+
+    def run_workers(self):
+        """
+        Runs the current queue with one sender thread per bot, each
+        with its own :class:`pyclassic.queue.TokenBucket`. Blocks until
+        the queue is done or the thread event is set. Used
+        internally.
+
+        A bot raising an exception stops, its blocks are sent by the
+        other bots.
+
+        :raise pyclassic.queue.QueueError: Every bot failed before the
+                                           end of the queue.
+        """
+        if self.chunks is None:
+            self.chunks = self.split_work()
+        event = self.thread_event or threading.Event()
+        self.errors = []
+        workers = [threading.Thread(
+            target = self.worker,
+            args = (i, TokenBucket(self.rate, self.burst), event))
+                   for i in range(len(self.bots))]
+        for t in workers: t.start()
+        for t in workers: t.join()
+        if self.remaining() and not event.is_set():
+            error = self.errors[-1] if self.errors else None
+            raise QueueError(f"Every bot failed, {self.remaining()} "
+                             "blocks left.") from error
 
     def do_all_blockqueues(self):
         """
@@ -181,20 +760,22 @@ class ThreadedQueue:
             point of this class but do as you wish.
             See :func:`pyclassic.queue.ThreadedQueue.start_all`.
         """
-        while self.queues != []:
-            self.do_blockqueue(False)
-            if self.thread and self.thread_event.is_set():
-                return
-
-        if self.thread:
-            self.thread = None
-            self.thread_event = None
+        try:
+            while self.queues or self.remaining() or self.stream:
+                self.do_blockqueue(False)
+                if self.thread and self.thread_event.is_set():
+                    return
+        finally:
+            if self.thread and not self.thread_event.is_set():
+                self.thread = None
+                self.thread_event = None
 
     def make_thread(self, **kargs):
         """
         Helper function used internally to make and start a thread.
         """
-        if not self.queues and not self.current_queue: return
+        if not self.queues and not self.remaining() and \
+           not self.stream: return
         if self.thread: return
         t = threading.Thread(**kargs)
         self.thread_event = threading.Event()
@@ -0,0 +1,388 @@
+"""
+This module implements a chunked map format with random access,
+meant for big maps. Unlike the format of :mod:`pyclassic.map`, which
+is a single gzip stream, the map is tiled into cubic chunks (16x16x16
+by default) compressed independently. Reading a region only
+decompresses the chunks it touches and saving a map only rewrites the
+chunks that changed.
+
+.. note::
+    The file starts with a 32 bytes header: the magic `PCREGION`, the
+    3 offset shorts, the 3 size shorts and the chunk size (short),
+    padded with zeros. It is followed by the chunk index, one entry
+    per chunk in the Y, Z, X order made of the position of the chunk
+    data in the file (8 bytes), its compressed length, the space
+    allocated for it and the CRC32 of the uncompressed chunk (4 bytes
+    each). Chunks are compressed with zlib, a length of 0 means that
+    the chunk is only made of air.
+
+Example::
+
+    # Convert a map saved with ClassicMap.save
+    pyclassic.region.convert("world.map", "world.region")
+
+    with pyclassic.region.RegionFile("world.region", True) as rf:
+        spawn = rf.load_region(((0, 0, 0), (31, 63, 31)))
+        offset, themap = rf.load()
+        themap[1, 2, 3] = 1
+        # Changes are tracked since the map was loaded, only the
+        # chunk that changed is compressed and rewritten.
+        rf.save(themap)
+"""
+import struct, zlib
+import pyclassic.map as pmap
+
+from .utils import decint, encint
+
+class RegionError(Exception): pass
+
+_magic = b'PCREGION'
+_header_size = 32
+_entry = struct.Struct('>QIII')
+
+class RegionFile:
+    """
+    A chunked map file opened for random access.
+
+    :param filename: File name
+    :param writable: Open the file in read/write mode
+
+    :type filename: str
+    :type writable: bool, optional
+
+    :raise pyclassic.region.RegionError: Not a region file.
+    """
+    def __init__(self, filename, writable = False):
+        self.file = open(filename, "r+b" if writable else "rb")
+        header = self.file.read(_header_size)
+        if header[:len(_magic)] != _magic:
+            self.file.close()
+            raise RegionError("Not a region file.")
+        values = [decint(header[x:x+2]) for x in range(8, 22, 2)]
+        #: Offset of the map
+        self.offset = tuple(values[:3])
+        self.width, self.height, self.length = values[3:6]
+        self.chunk_size = values[6]
+
+        cs = self.chunk_size
+        self.nx = -(-self.width // cs)
+        self.ny = -(-self.height // cs)
+        self.nz = -(-self.length // cs)
+        count = self.nx*self.ny*self.nz
+        data = self.file.read(count*_entry.size)
+        #: Chunk index, [position, length, capacity, crc] per chunk.
+        self.index = [list(_entry.unpack_from(data, i*_entry.size))
+                      for i in range(count)]
+        # Change tracker of the last map saved or loaded and its
+        # version at that time, see save.
+        self.synced = None
+
+    @classmethod
+    def create(cls, filename, width, height, length, offset = (0, 0, 0),
+               chunk_size = 16):
+        """
+        Creates an empty (only air) region file and opens it in
+        read/write mode.
+
+        :param filename:   File name
+        :param offset:     Offset of the map
+        :param chunk_size: Size of the chunks
+
+        :type filename:   str
+        :type width:      int
+        :type height:     int
+        :type length:     int
+        :type offset:     (int, int, int), optional
+        :type chunk_size: int, optional
+
+        :rtype: :class:`pyclassic.region.RegionFile`
+        """
+        header = _magic + b''.join(encint(x) for x in offset) + \
+            encint(width) + encint(height) + encint(length) + \
+            encint(chunk_size)
+        nx, ny, nz = [-(-x // chunk_size) for x in (width, height, length)]
+
+        with open(filename, "wb") as f:
+            f.write(header.ljust(_header_size, b'\0'))
+            for cy in range(ny):
+                for cz in range(nz):
+                    for cx in range(nx):
+                        n = len(range(cx*chunk_size,
+                                      min((cx+1)*chunk_size, width))) * \
+                            len(range(cy*chunk_size,
+                                      min((cy+1)*chunk_size, height))) * \
+                            len(range(cz*chunk_size,
+                                      min((cz+1)*chunk_size, length)))
+                        f.write(_entry.pack(0, 0, 0, zlib.crc32(bytes(n))))
+        return cls(filename, True)
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Closes the file.
+        """
+        self.file.close()
+
+    ##################################################################
+    def chunk_box(self, cx, cy, cz):
+        """
+        :return: The two corners (both included) of a chunk
+        :rtype:  ((int, int, int), (int, int, int))
+        """
+        cs = self.chunk_size
+        return (cx*cs, cy*cs, cz*cs), \
+            (min((cx+1)*cs, self.width) - 1,
+             min((cy+1)*cs, self.height) - 1,
+             min((cz+1)*cs, self.length) - 1)
+
+    def chunks_in(self, box):
+        """
+        Lists the chunks touched by a box.
+
+        :param box: Two corners (both included), already clipped
+        :return: Chunk coordinates
+        :rtype:  iterator[(int, int, int)]
+        """
+        (ax, ay, az), (bx, by, bz) = box
+        cs = self.chunk_size
+        for cy in range(ay // cs, by // cs + 1):
+            for cz in range(az // cs, bz // cs + 1):
+                for cx in range(ax // cs, bx // cs + 1):
+                    yield cx, cy, cz
+
+    def chunk_index(self, cx, cy, cz):
+        """
+        :return: Position of a chunk in the index
+        :rtype:  int
+        """
+        return (cy*self.nz + cz)*self.nx + cx
+
+    def read_chunk_data(self, cx, cy, cz):
+        """
+        Reads and decompresses the raw blocks of a chunk.
+
+        :return: Raw chunk blocks (Y, Z, X order)
+        :rtype:  bytearray
+        """
+        (ax, ay, az), (bx, by, bz) = self.chunk_box(cx, cy, cz)
+        n = (bx-ax+1)*(by-ay+1)*(bz-az+1)
+        pos, size, cap, crc = self.index[self.chunk_index(cx, cy, cz)]
+        if not size:
+            return bytearray(n)
+
+        self.file.seek(pos)
+        data = zlib.decompress(self.file.read(size))
+        if len(data) != n:
+            raise RegionError("Corrupted chunk.")
+        return bytearray(data)
+
+    def read_chunk(self, cx, cy, cz):
+        """
+        Reads and decompresses a chunk.
+
+        :return: The chunk as a map
+        :rtype:  :class:`pyclassic.map.ClassicMap`
+        """
+        (ax, ay, az), (bx, by, bz) = self.chunk_box(cx, cy, cz)
+        return pmap.ClassicMap.from_blocks(
+            self.read_chunk_data(cx, cy, cz), bx-ax+1, by-ay+1, bz-az+1)
+
+    def write_chunk(self, cx, cy, cz, data, compresslevel = 6):
+        """
+        Compresses and writes a chunk. It is written in place if it
+        fits in the space allocated for it, otherwise at the end of
+        the file.
+
+        :param data: Raw chunk blocks (Y, Z, X order)
+        :type data:  bytes
+        """
+        i = self.chunk_index(cx, cy, cz)
+        entry = self.index[i]
+        crc = zlib.crc32(data)
+        if data.count(0) == len(data):
+            compressed = b''
+        else:
+            compressed = zlib.compress(data, compresslevel)
+
+        if len(compressed) > entry[2]:
+            self.file.seek(0, 2)
+            entry[0], entry[2] = self.file.tell(), len(compressed)
+        if compressed:
+            self.file.seek(entry[0])
+            self.file.write(compressed)
+        entry[1], entry[3] = len(compressed), crc
+
+        self.file.seek(_header_size + i*_entry.size)
+        self.file.write(_entry.pack(*entry))
+
+    ##################################################################
+    def load_region(self, box):
+        """
+        Loads a region of the map. Only the chunks touched by the
+        region are read and decompressed.
+
+        :param box: Two opposite corners of the region (both included)
+        :type box:  ((int, int, int), (int, int, int))
+
+        :return: The region as a map or None if it is outside of the
+                 map.
+        :rtype:  :class:`pyclassic.map.ClassicMap` or None
+        """
+        (x1, y1, z1), (x2, y2, z2) = box
+        (ax, ay, az), (bx, by, bz) = box = (
+            (max(min(x1, x2), 0), max(min(y1, y2), 0),
+             max(min(z1, z2), 0)),
+            (min(max(x1, x2), self.width-1),
+             min(max(y1, y2), self.height-1),
+             min(max(z1, z2), self.length-1)))
+        if ax > bx or ay > by or az > bz:
+            return None
+
+        w, h, l = bx-ax+1, by-ay+1, bz-az+1
+        result = pmap.ClassicMap.from_blocks(bytearray(w*h*l), w, h, l)
+        for cx, cy, cz in self.chunks_in(box):
+            (cax, cay, caz), (cbx, cby, cbz) = self.chunk_box(cx, cy, cz)
+            if not self.index[self.chunk_index(cx, cy, cz)][1]:
+                continue # Only air
+            chunk = self.read_chunk(cx, cy, cz)
+
+            # Intersection between the chunk and the region
+            ix1, iy1, iz1 = max(ax, cax), max(ay, cay), max(az, caz)
+            ix2, iy2, iz2 = min(bx, cbx), min(by, cby), min(bz, cbz)
+            n = ix2 - ix1 + 1
+            for y in range(iy1, iy2+1):
+                for z in range(iz1, iz2+1):
+                    i = (ix1-ax) + (z-az)*w + (y-ay)*w*l
+                    j = (ix1-cax) + (z-caz)*chunk.width + \
+                        (y-cay)*chunk.width*chunk.length
+                    result.blocks[i:i+n] = chunk.blocks[j:j+n]
+        return result
+
+    def load(self):
+        """
+        Loads the whole map. Changes made to it are tracked (see
+        :func:`pyclassic.map.ClassicMap.track_changes`) so that
+        :func:`save` only looks at the chunks that changed.
+
+        :return: The offset and the map object.
+        :rtype:  (int, int, int), :class:`pyclassic.map.ClassicMap`
+        """
+        m = self.load_region(
+            ((0, 0, 0), (self.width-1, self.height-1, self.length-1)))
+        m.track_changes(self.chunk_size)
+        self.synced = (m.tracker, m.tracker.version)
+        return self.offset, m
+
+    def save(self, classic_map, chunks = None, compresslevel = 6):
+        """
+        Saves a map in the file. Only the chunks that changed are
+        compressed and rewritten. Unless the chunks to write are given,
+        they are found with the change tracker of the map (see
+        :func:`pyclassic.map.ClassicMap.track_changes`) if it has
+        tracked every change since the map was last loaded from or
+        saved in this file. Otherwise every chunk is compared with the
+        file: chunks are only read back when their CRC32 matches the
+        index, to make sure they did not change.
+
+        :param classic_map: Map to save, it must have the same size
+        :param chunks: Chunks to write
+        :param compresslevel: zlib compression level
+
+        :type classic_map: :class:`pyclassic.map.ClassicMap`
+        :type chunks: iterable[(int, int, int)], optional
+        :type compresslevel: int, optional
+
+        :raise pyclassic.region.RegionError: The map has another size.
+        :return: Amount of chunks written
+        :rtype:  int
+        """
+        m = classic_map
+        if (m.width, m.height, m.length) != \
+           (self.width, self.height, self.length):
+            raise RegionError("The map size does not match.")
+        tracker = m.tracker
+        check = sync = False
+        if chunks is None:
+            sync = True
+            if self.synced and self.synced[0] is tracker and \
+               tracker.chunk_size == self.chunk_size:
+                chunks = tracker.dirty_chunks(self.synced[1])
+            else:
+                chunks = [(cx, cy, cz) for cy in range(self.ny)
+                          for cz in range(self.nz)
+                          for cx in range(self.nx)]
+                check = True
+
+        blocks = memoryview(m.blocks)
+        written = 0
+        for cx, cy, cz in chunks:
+            data = b''.join(blocks[i:j] for i, j in
+                            m.rows(self.chunk_box(cx, cy, cz)))
+            if check and zlib.crc32(data) == \
+               self.index[self.chunk_index(cx, cy, cz)][3] and \
+               self.read_chunk_data(cx, cy, cz) == data:
+                continue
+            self.write_chunk(cx, cy, cz, data, compresslevel)
+            written += 1
+        self.file.flush()
+        if sync and tracker:
+            self.synced = (tracker, tracker.version)
+        return written
+
+def load(filename):
+    """
+    Loads a whole map from a region file.
+
+    :param filename: File name
+    :type filename:  str
+
+    :return: The offset and the map object.
+    :rtype:  (int, int, int), :class:`pyclassic.map.ClassicMap`
+    """
+    with RegionFile(filename) as rf:
+        return rf.load()
+
+def save(classic_map, filename, offset = (0, 0, 0), chunk_size = 16,
+         compresslevel = 6):
+    """
+    Saves a map in a new region file.
+
+    :param classic_map: Map to save
+    :param filename:    File name
+    :param offset:      Offset of the map
+    :param chunk_size:  Size of the chunks
+    :param compresslevel: zlib compression level
+
+    :type classic_map: :class:`pyclassic.map.ClassicMap`
+    :type filename:    str
+    :type offset:      (int, int, int), optional
+    :type chunk_size:  int, optional
+    :type compresslevel: int, optional
+    """
+    m = classic_map
+    with RegionFile.create(filename, m.width, m.height, m.length,
+                           offset, chunk_size) as rf:
+        rf.save(m, compresslevel = compresslevel)
+
+def convert(source, destination, chunk_size = 16, compresslevel = 6):
+    """
+    Converts a map saved with :func:`pyclassic.map.ClassicMap.save`
+    (or any file :func:`pyclassic.map.load` can read) into a region
+    file.
+
+    :param source:      Legacy map file name
+    :param destination: Region file name
+    :param chunk_size:  Size of the chunks
+
+    :type source:      str
+    :type destination: str
+    :type chunk_size:  int, optional
+    :type compresslevel: int, optional
+    """
+    offset, m = pmap.load(source)
+    with m:
+        save(m, destination, offset, chunk_size, compresslevel)
@@ -3,8 +3,8 @@ This module contains a bunch of useful functions. I am not going to
 document this because those are mostly helpers for other modules. I
 will only document the functions that can be useful for the developer.
 """
-import re
-from dataclasses import dataclass
+import re, struct
+from dataclasses import dataclass, field
 
 ######################################################################
 class PyClassicError(Exception): pass
@@ -13,11 +13,22 @@ _packet_fmt_types = {
     "BYTE": 1, "SBYTE": 1, "SHORT": 2, "STRING": 64, "ARRAY": 1024, "INT": 4
 }
 
+# struct codes used to encode and decode each field type. Integers are
+# encoded unsigned (values get masked on overflow like the old encoder
+# did) but decoded with their actual signedness.
+_packet_struct_codes = {
+    "BYTE": ("B", "B"), "SBYTE": ("B", "b"), "SHORT": ("H", "h"),
+    "STRING": ("64s", "64s"), "ARRAY": ("1024s", "1024s"), "INT": ("I", "i")
+}
+_packet_masks = {
+    "BYTE": 0xff, "SBYTE": 0xff, "SHORT": 0xffff, "INT": 0xffffffff
+}
+
 _cc_api = "http://www.classicube.net/api"
 ######################################################################
 
 enc = lambda n: n.encode('us-ascii')
-encstr = lambda n: enc(n) + bytes([0x20 for x in range(64-len(enc(n)))])
+encstr = lambda n: enc(n).ljust(64, b' ')
 decstr = lambda n: n[:64].decode('us-ascii').strip()
 decint = lambda n, s = True: int.from_bytes(n, byteorder='big',
                                      signed=s)
@@ -42,50 +53,111 @@ def contains_all(needle, haystack):
             return False
     return True
 
+class PacketCodec:
+    """
+    Precompiled encoder and decoder of a packet format. Every
+    :class:`PacketFormat` compiles its own codec once when it is
+    created so packets are (de)serialized with a single
+    :class:`struct.Struct` call instead of field by field.
+
+    :param content: List of field types (BYTE, SBYTE, SHORT, ...)
+    :type content:  list[str]
+    """
+    def __init__(self, content):
+        self.encoder = struct.Struct(
+            '>' + ''.join(_packet_struct_codes[f][0] for f in content))
+        self.decoder = struct.Struct(
+            '>' + ''.join(_packet_struct_codes[f][1] for f in content))
+        #: Size of the packet without the packet ID.
+        self.size = self.decoder.size
+        #: Amount of fields.
+        self.fields = len(content)
+        self.strings = tuple(i for i, f in enumerate(content)
+                             if f == "STRING")
+        self.arrays = tuple(i for i, f in enumerate(content)
+                            if f == "ARRAY")
+        self.masks = tuple(_packet_masks.get(f) for f in content)
+
+    def _prepare(self, args):
+        if self.strings or self.arrays:
+            args = list(args)
+            for i in self.strings: args[i] = encstr(args[i][:64])
+            for i in self.arrays:  args[i] = bytes(args[i][:1024])
+        return args
+
+    def _mask(self, args):
+        return [a & m if m else a for a, m in zip(args, self.masks)]
+
+    def pack(self, *args):
+        """
+        Encodes the arguments into a new bytes object.
+
+        :return: Encoded packet (without the packet ID)
+        :rtype:  bytes
+        """
+        args = self._prepare(args)
+        try:
+            return self.encoder.pack(*args)
+        except struct.error:
+            return self.encoder.pack(*self._mask(args))
+
+    def pack_into(self, buffer, offset, *args):
+        """
+        Encodes the arguments straight into a writable buffer such as
+        a bytearray or a memoryview.
+
+        :param buffer: Buffer to write into
+        :param offset: Where to write the packet in the buffer
+        :type offset:  int
+        """
+        args = self._prepare(args)
+        try:
+            self.encoder.pack_into(buffer, offset, *args)
+        except struct.error:
+            self.encoder.pack_into(buffer, offset, *self._mask(args))
+
+    def unpack_from(self, buffer, offset = 0):
+        """
+        Decodes a packet from a buffer without copying it first.
+
+        :param buffer: Buffer to read from (bytes, bytearray,
+                       memoryview...)
+        :param offset: Where the packet starts in the buffer
+        :type offset:  int, optional
+
+        :return: Decoded arguments
+        :rtype:  list
+        """
+        args = list(self.decoder.unpack_from(buffer, offset))
+        for i in self.strings:
+            args[i] = args[i].decode('us-ascii').strip()
+        return args
+
 # BYTE, SBYTE, SHORT, ARRAY, STRING
 @dataclass
 class PacketFormat:
     pid: int
     name: str
     content: list
+    codec: PacketCodec = field(init = False, repr = False,
+                               compare = False)
+
+    def __post_init__(self):
+        self.codec = PacketCodec(self.content)
 
     def __len__(self):
-        return sum(_packet_fmt_types[x] for x in self.content)
+        return self.codec.size
     def __bool__(self):
         return True
 
 def find_packet_id(t):
-    for c, i in enumerate(packet_id_s):
-        if t == packet_id_s[i].name:
-            return packet_id_s[i].pid
-    return -1
+    return packet_names.get(t, -1)
 def encode_packet(fmt, *args):
-    if len(args) != len(fmt.content): return
-
-    packet = b''
-    for f, a in zip(fmt.content, args):
-        if   f == "BYTE":   packet += bytes([a & 0xff])
-        elif f == "SBYTE":  packet += encint(a, 1)
-        elif f == "SHORT":  packet += encint(a&0xffff, 2)
-        elif f == "STRING": packet += encstr(a[:64])
-        elif f == "ARRAY":  packet += a[:1024]
-        elif f == "INT":    packet += encint(a, 4)
-    return packet
+    if len(args) != fmt.codec.fields: return
+    return fmt.codec.pack(*args)
 def decode_packet(fmt, packet: bytes):
     if len(fmt) != len(packet): return
-
-    args = []
-    for f in fmt.content:
-        if   f == "BYTE":   args.append(packet[0])
-        elif f == "SBYTE":  args.append(decint(packet[:1]))
-        elif f == "SHORT":  args.append(decint(packet[:2]))
-        elif f == "STRING": args.append(decstr(packet[:64]))
-        elif f == "ARRAY":  args.append(packet[:1024])
-        elif f == "INT":    args.append(decint(packet[:4]))
-
-        packet = packet[_packet_fmt_types[f]:]
-
-    return args
+    return fmt.codec.unpack_from(packet)
 
 packet_id_s = {
     0x0: PacketFormat(0, "AUTH", ['BYTE', 'STRING', 'STRING', 'BYTE']),
@@ -120,3 +192,6 @@ packet_id_c = {
     0x11: PacketFormat(17, "EXT_ENTRY", ["STRING", "INT"]),
     0x13: PacketFormat(19, "CUSTOM_BLOCK_LEVEL", ["BYTE"])
 }
+
+# Received packet IDs by name, see find_packet_id.
+packet_names = {fmt.name: pid for pid, fmt in packet_id_s.items()}